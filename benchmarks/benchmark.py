@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# Path: benchmarks/benchmark.py
+# Author: Olle Holmberg, 2022-2023
+# License: GPL v3
+#
+# https://github.com/unremarkablegarden/scala2mts
+
+
+"""
+Time every stage of the conversion, the whole conversion and a request to
+the web app, on the Scala files in benchmarks/corpus/ and on synthetic
+scales of 5, 12, 100 and 1000 notes (once in ratios, once in cents).
+
+python benchmarks/benchmark.py [-r repeat] [-o results.json] [--compare baseline.json] [--threshold 0.25]
+
+-r repeat: how many times each stage runs on each input (default: 50)
+-o output: save the results as JSON, to compare later runs against
+--compare baseline: compare against the JSON of an earlier run, and exit with 1
+    if any stage got slower than the baseline by more than the threshold
+--threshold fraction: how much slower counts as a regression (default: 0.25 = 25%)
+--no-web: skip the web app, for machines without Flask
+
+Stages, each timed on its own with the engine's caches cleared before every run:
+
+    decode        bytes to text, including chardet for files that need it
+    parse         text to a Scale
+    cents         the notes to cents and ratios (scale_to_cents, cents_to_ratios)
+    frequencies   the 128 note frequencies (tuning_frequencies)
+    freq_data     the frequency data words (hz_to_freq_data)
+    checksum      the XOR checksum of a finished bulk dump
+    sysex         byte assembly of the bulk dump, checksum included
+    scl_to_syx    the whole conversion, from text
+    web           a POST to home() through the Flask test client, from bytes
+
+Regressions are judged on the fastest run of each stage, which is the least
+noisy. A fixed pure Python workload is timed the same way between the
+inputs, and the stages are compared relative to it, so a machine that is
+busier or slower overall doesn't look like a regression. Still, only
+compare runs from the same kind of machine. Changes of less than 2 us are
+never counted, they are within the resolution of a single run.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import math
+import random
+import gc
+import getopt
+import platform
+import statistics
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+CORPUS_DIRECTORY = os.path.join(BENCHMARK_DIRECTORY, 'corpus')
+sys.path.insert(0, os.path.join(BENCHMARK_DIRECTORY, '..'))
+
+import mtsengine
+
+SYNTHETIC_SIZES = (5, 12, 100, 1000)
+# changes smaller than this are timer noise, whatever the percentage
+MIN_REGRESSION_US = 2.0
+
+STAGES = ('decode', 'parse', 'cents', 'frequencies', 'freq_data', 'checksum', 'sysex', 'scl_to_syx', 'web')
+
+# the memoized parts of the engine, cleared so every run converts a scale it hasn't seen
+CACHED_FUNCTIONS = (mtsengine.parse_ratio_integers, mtsengine.parse_ratio, mtsengine._ratio_log2, mtsengine.note_to_cents)
+
+
+def clear_caches():
+    for function in CACHED_FUNCTIONS:
+        function.cache_clear()
+
+
+# --------------------------------------------------------
+
+# a Scala file with count notes that repeats at 2/1, in ratios or in cents
+def synthetic_scale(count, kind, seed=0):
+    rng = random.Random("%d-%s-%d" % (count, kind, seed))
+    lines = ["! synthetic-%d-%s.scl" % (count, kind), "!", "Synthetic %d note scale in %s" % (count, kind), " %d" % count, "!"]
+    if kind == 'ratios':
+        # distinct ratios between 1/1 and 2/1 with small primes, like most of the archive
+        ratios = set()
+        while len(ratios) < count - 1:
+            denom = rng.randint(2, 4 * count)
+            num = rng.randint(denom + 1, 2 * denom - 1)
+            ratios.add((num, denom))
+        lines += [" %d/%d" % ratio for ratio in sorted(ratios, key=lambda ratio: ratio[0] / ratio[1])] + [" 2/1"]
+    else:
+        cents = sorted(rng.uniform(0, 1200) for i in range(count - 1))
+        lines += [" %.5f" % value for value in cents] + [" 1200.00000"]
+    return ("\n".join(lines) + "\n").encode('ascii')
+
+
+# (name, bytes) for every input
+def benchmark_inputs():
+    inputs = []
+    for name in sorted(os.listdir(CORPUS_DIRECTORY)):
+        if name.endswith('.scl'):
+            with open(os.path.join(CORPUS_DIRECTORY, name), 'rb') as f:
+                inputs.append((name, f.read()))
+    for count in SYNTHETIC_SIZES:
+        for kind in ('ratios', 'cents'):
+            inputs.append(("synthetic-%d-%s" % (count, kind), synthetic_scale(count, kind)))
+    return inputs
+
+
+# --------------------------------------------------------
+
+# time every function once per round, for repeat rounds, clearing the caches before each run
+# but outside the timing, so every function's runs are spread over the whole benchmark and a
+# burst of load on the machine slows a single run of each, instead of all runs of one
+# returns {key: run times in microseconds}, without garbage collection like timeit
+def time_rounds(functions, repeat):
+    times = dict((key, []) for key in functions)
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(repeat):
+            for key, function in functions.items():
+                clear_caches()
+                start = time.perf_counter()
+                function()
+                times[key].append((time.perf_counter() - start) * 1e6)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return times
+
+
+# a fixed workload of float math, string handling and small allocations, like the pipeline
+def calibration_workload():
+    total = 0.0
+    words = []
+    for i in range(1, 2001):
+        total += math.log2(i) * 1200 / 12
+        words.append(("%.5f" % total).split("."))
+    return total, len(words)
+
+
+def web_client():
+    # every request converts, instead of hitting the result cache or the scale store
+    # (also used by equivalence.py)
+    os.environ['SCALA2MTS_CACHE_ENTRIES'] = '0'
+    os.environ['SCALA2MTS_STORE'] = ''
+    sys.path.insert(0, os.path.join(BENCHMARK_DIRECTORY, '..', 'vercel', 'api'))
+    from _webapp import app
+    return app.test_client()
+
+
+# {stage: function} for one input
+def input_stages(data, client=None):
+    text = mtsengine.decode_scala(data)
+    scale = mtsengine.parse_scala(text)
+    scala_cents = mtsengine.scale_to_cents(scale.notes)
+    scala_ratios = mtsengine.cents_to_ratios(scala_cents, scale.notes)
+    scala_freqs = mtsengine.tuning_frequencies(scala_ratios, scale.notes_per_octave, scala_cents=scala_cents)
+    scala_freq_data = [mtsengine.hz_to_freq_data(freq) for freq in scala_freqs]
+    sysex = mtsengine.build_sysex(scale.name, scala_freq_data, 1)
+
+    stages = {
+        'decode': lambda: mtsengine.decode_scala(data),
+        'parse': lambda: mtsengine.parse_scala(text),
+        'cents': lambda: mtsengine.cents_to_ratios(mtsengine.scale_to_cents(scale.notes), scale.notes),
+        'frequencies': lambda: mtsengine.tuning_frequencies(scala_ratios, scale.notes_per_octave, scala_cents=scala_cents),
+        'freq_data': lambda: [mtsengine.hz_to_freq_data(freq) for freq in scala_freqs],
+        'checksum': lambda: mtsengine.xor_bytes(sysex[1:mtsengine.CHECKSUM_OFFSET]) & 0x7F,
+        'sysex': lambda: mtsengine.build_sysex(scale.name, scala_freq_data, 1),
+        'scl_to_syx': lambda: mtsengine.scl_to_syx(text),
+    }
+    if client is not None:
+        def web():
+            response = client.post('/', data={'file': (io.BytesIO(data), 'benchmark.scl'), 'program_number': '1', 'base_note': '69', 'base_freq': '440'})
+            if response.status_code != 200:
+                raise Exception("the web app answered %d" % response.status_code)
+        stages['web'] = web
+    return stages
+
+
+# --------------------------------------------------------
+
+def environment():
+    chardet_version = None
+    try:
+        import chardet
+        chardet_version = chardet.__version__
+    except ImportError:
+        pass
+    numpy = mtsengine.load_numpy()
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'system': platform.system(),
+        'chardet': chardet_version,
+        'numpy': numpy.__version__ if numpy is not None else None,
+    }
+
+
+# the stages that got slower than in baseline by more than threshold, relative to the calibration,
+# as a list of (input, stage, baseline us, now us, relative change)
+def find_regressions(baseline, results, threshold):
+    speed = baseline['calibration_us'] / results['calibration_us']
+    regressions = []
+    for name, stages in results['results'].items():
+        for stage, timing in stages.items():
+            before = baseline['results'].get(name, {}).get(stage)
+            if before is None:
+                continue
+            now = timing['min_us'] * speed
+            change = now / before['min_us'] - 1
+            if change > threshold and now - before['min_us'] > MIN_REGRESSION_US:
+                regressions.append((name, stage, before['min_us'], timing['min_us'], change))
+    return regressions
+
+
+def print_results(results):
+    stages = [stage for stage in STAGES if any(stage in timings for timings in results['results'].values())]
+    width = max(len(name) for name in results['results'])
+    print("fastest run in microseconds, %d runs each" % results['repeat'])
+    print(" " * width + "".join("%12s" % stage for stage in stages))
+    for name, timings in results['results'].items():
+        print(name.ljust(width) + "".join("%12.1f" % timings[stage]['min_us'] if stage in timings else "%12s" % "-" for stage in stages))
+
+
+def main(argv):
+    repeat = 50
+    output_file = None
+    baseline_file = None
+    threshold = 0.25
+    web = True
+
+    try:
+        opts, args = getopt.getopt(argv, "hr:o:", ["help", "repeat=", "output=", "compare=", "threshold=", "no-web"])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print(__doc__)
+            sys.exit()
+        elif o in ("-r", "--repeat"):
+            repeat = int(a)
+        elif o in ("-o", "--output"):
+            output_file = a
+        elif o == "--compare":
+            baseline_file = a
+        elif o == "--threshold":
+            threshold = float(a)
+        elif o == "--no-web":
+            web = False
+
+    client = web_client() if web else None
+
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(),
+        'repeat': repeat,
+        'results': {},
+    }
+    functions = {'calibration': calibration_workload}
+    for name, data in benchmark_inputs():
+        for stage, function in input_stages(data, client).items():
+            functions[name, stage] = function
+
+    times = time_rounds(functions, repeat)
+    results['calibration_us'] = min(times.pop('calibration'))
+    for (name, stage), stage_times in times.items():
+        results['results'].setdefault(name, {})[stage] = {'min_us': min(stage_times), 'median_us': statistics.median(stage_times)}
+
+    print_results(results)
+
+    if output_file is not None:
+        with open(output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Wrote " + output_file)
+
+    if baseline_file is not None:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        if baseline['environment'] != results['environment']:
+            print("Warning: the baseline was measured in a different environment, %r" % baseline['environment'])
+        print("Calibration %.1f us, baseline %.1f us" % (results['calibration_us'], baseline['calibration_us']))
+        regressions = find_regressions(baseline, results, threshold)
+        for name, stage, before, now, change in regressions:
+            print("Regression: %s %s %.1f us -> %.1f us (%+.0f%% relative to the calibration)" % (name, stage, before, now, change * 100))
+        print("%d regressions past %.0f%% against %s" % (len(regressions), threshold * 100, baseline_file))
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,724 @@
+#!/usr/bin/env python3
+# Path: benchmarks/equivalence.py
+# Author: Olle Holmberg, 2022-2023
+# License: GPL v3
+#
+# https://github.com/unremarkablegarden/scala2mts
+
+
+"""
+Check that every way of converting a Scala file gives the same bulk dump:
+run random scales and the Scala files in benchmarks/corpus/ through each
+implementation, compare the bytes, the frequencies and the checksums, and
+stop at the first mismatch with the smallest Scala file that still shows it.
+
+python benchmarks/equivalence.py [-n count] [--seed n] [-f files] [options]
+
+-n count: how many random scales to check (default: 1000)
+--seed n: the seed of the random scales, the same seed checks the same scales (default: 0)
+-f files: a directory or glob of Scala files to check as well (default: benchmarks/corpus)
+--only names: only run these implementations, separated by commas (engine always runs)
+--skip names: don't run these implementations, separated by commas
+-o output: write the minimal reproducer to this .scl file
+--no-shrink: report the mismatch as found, without making it smaller
+-v verbose: print every scale as it is checked
+
+Implementations, each compared with engine:
+
+    engine           mtsengine.scl_to_syx, what the CLI, GUI and web app call
+    session          a TuningSession
+    session-reuse    a TuningSession with other parameters first, then changed,
+                     so only the later stages are recomputed and the program
+                     number is patched into the cached dump
+    tables-numpy     tuning_tables, vectorized with numpy
+    tables-python    tuning_tables without numpy
+    store            a scale store built with the scale's base note and frequency
+    store-recompute  a scale store built for 69 / 440 Hz, recomputed from its cents
+    cli              scala2mts.py's batch conversion of one file
+    gui              scala2mts-gui.py's convert_scl_to_syx, without opening a window
+    web              a POST to the Flask app, through its test client
+    reference        an independent conversion in 40 digit Decimal arithmetic,
+                     straight from the Scala and MTS specifications
+
+The implementations must agree on which files are rejected, none of them
+may crash (even if all of them do, that is a bug too), and they must produce
+the same bytes, and where they expose them, frequencies within a relative
+1e-9. The reference is exact instead of rounded like a float, so its
+frequency data words may be 1 unit (0.006 cents) off where a float lands
+on the other side of a rounding boundary. A new fast path only needs a
+function in IMPLEMENTATIONS to be checked against all of this.
+
+The exit status is 1 if any implementation disagrees.
+"""
+
+import os
+import io
+import re
+import ast
+import math
+import sys
+import glob
+import random
+import getopt
+import tempfile
+import warnings
+from collections import namedtuple
+from decimal import Decimal, localcontext, ROUND_HALF_EVEN
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIRECTORY = os.path.join(BENCHMARK_DIRECTORY, '..')
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+
+import mtsengine
+import mtsstore
+import scala2mts
+from benchmark import web_client
+
+# relative difference allowed between the frequencies of two implementations
+FREQ_TOLERANCE = 1e-9
+
+# a Scala file to convert and its parameters, spec is how a random scale was made (None for files)
+Case = namedtuple('Case', 'label data spec program_number base_note base_freq')
+# a random scale: its description, its pitches as written, and how the file is laid out
+Spec = namedtuple('Spec', 'description pitches layout')
+# what an implementation did with a case: kind is 'ok', 'rejected' (a ScalaError) or 'crashed'
+Outcome = namedtuple('Outcome', 'kind sysex freqs message')
+
+PLAIN_LAYOUT = {'name_comment': True, 'newline': '\n', 'indent': ' ', 'comments': False, 'trailing': False, 'encoding': 'ascii'}
+
+
+class Failure(Exception):
+    """
+    An error that an implementation only reports as text, kind is the name
+    of the exception it reported, e.g. ScalaError.
+    """
+
+    def __init__(self, kind, message):
+        self.kind = kind
+        super().__init__(message)
+
+
+# --------------------------------------------------------
+# random scales
+
+def random_ratio(rng):
+    # just intonation, made of small primes
+    num = denom = 1
+    for prime in (2, 3, 5, 7, 11, 13):
+        exponent = rng.choice((-2, -1, 0, 0, 0, 1, 2))
+        if exponent > 0:
+            num *= prime**exponent
+        elif exponent < 0:
+            denom *= prime**-exponent
+    return "%d/%d" % (num, denom)
+
+
+def random_pitch(rng):
+    kind = rng.random()
+    if kind < 0.35:
+        return random_ratio(rng)
+    if kind < 0.45:
+        return "%d/%d" % (rng.randint(1, 999), rng.randint(1, 999))
+    if kind < 0.5:
+        return "%d" % rng.randint(1, 9)
+    if kind < 0.9:
+        return "%.*f" % (rng.randint(1, 6), rng.uniform(0, 1200))
+    if kind < 0.98:
+        # unusual but valid cents
+        return rng.choice(("%.3f" % rng.uniform(-1200, 0), "%.3f" % rng.uniform(1200, 4800), "%d." % rng.randint(0, 1200), "%.1fe2" % rng.uniform(0, 12), "0.0", huge_cents(rng)))
+    return extreme_pitch(rng)
+
+
+# at the limits of what a program can read: cents just inside and past the float range,
+# and ratios just inside and past the number of digits int() reads (4300 by default)
+def extreme_pitch(rng):
+    return rng.choice((
+        "%.1fe307" % rng.uniform(-1.7, 1.7),
+        "%.1fe400" % rng.uniform(-9, 9),
+        "1" + "0" * rng.randint(4000, 4299) + "/1",
+        "3/1" + "0" * rng.randint(4300, 5000),
+        "1" + "0" * rng.randint(4300, 5000),
+    ))
+
+
+# far past the MIDI range, and past the float range once raised to a power
+def huge_cents(rng):
+    return "%.1f" % (rng.choice((-1, 1)) * 10**rng.uniform(4, 7))
+
+
+def random_period(rng):
+    kind = rng.random()
+    if kind < 0.5:
+        return rng.choice(("2/1", "2", "1200.0", "1200.00000"))
+    if kind < 0.7:
+        return rng.choice(("3/1", "3/2", "5/4", "4/1", "1/2"))
+    if kind < 0.9:
+        return "%.4f" % rng.uniform(100, 2400)
+    if kind < 0.95:
+        return huge_cents(rng)
+    return random_ratio(rng)
+
+
+# a broken copy of the pitches, that every implementation should reject
+def break_pitches(rng, pitches):
+    pitches = list(pitches)
+    i = rng.randrange(len(pitches))
+    pitches[i] = rng.choice(("abc", "0/1", "3/0", "0", "-3/2", "1.2.3", "3/2/1", "/2", "x", ""))
+    return pitches
+
+
+def random_spec(rng):
+    count = rng.choice((1, 2, 3, 5, 7, 12, 12, 12, 19, 22, 31, 43, 53, 72, rng.randint(1, 200)))
+    pitches = [random_pitch(rng) for i in range(count - 1)] + [random_period(rng)]
+    if rng.random() < 0.03:
+        pitches = break_pitches(rng, pitches)
+    layout = {
+        'name_comment': rng.random() < 0.8,
+        'newline': rng.choice(('\n', '\n', '\r\n')),
+        'indent': rng.choice((' ', ' ', '', '\t')),
+        'comments': rng.random() < 0.2,
+        'trailing': rng.random() < 0.2,
+        'encoding': rng.choice(('ascii', 'ascii', 'utf-8', 'utf-8-sig', 'cp1252')),
+    }
+    description = rng.choice(("Random scale", "Random scale, %d notes" % count, "Gamme dérivée", ""))
+    return Spec(description, pitches, layout)
+
+
+# the bytes of a Scala file for a spec
+def render_spec(spec, name):
+    layout = spec.layout
+    lines = []
+    if layout['name_comment']:
+        lines += ["! %s.scl" % name, "!"]
+    lines.append(spec.description)
+    lines.append(layout['indent'] + "%d" % len(spec.pitches))
+    lines.append("!")
+    for i, pitch in enumerate(spec.pitches):
+        if layout['comments'] and i % 3 == 1:
+            lines.append("! degree %d" % (i + 1))
+        line = layout['indent'] + pitch
+        if layout['trailing'] and pitch:
+            line += "  degree %d" % (i + 1)
+        lines.append(line)
+    text = layout['newline'].join(lines) + layout['newline']
+    if layout['encoding'] == 'ascii':
+        return text.encode('ascii', 'replace')
+    return text.encode(layout['encoding'])
+
+
+def make_case(label, spec, program_number, base_note, base_freq):
+    return Case(label, render_spec(spec, label), spec, program_number, base_note, base_freq)
+
+
+def random_params(rng):
+    base_note = rng.choice((69, 60, 69, rng.randint(0, 127), 0, 127))
+    base_freq = rng.choice((440.0, 261.6255653005986, 440.0, rng.uniform(20, 2000), rng.uniform(1, 20000)))
+    return rng.randint(0, 127), base_note, base_freq
+
+
+def random_cases(count, seed):
+    rng = random.Random(seed)
+    for i in range(count):
+        spec = random_spec(rng)
+        yield make_case("random-%d" % i, spec, *random_params(rng))
+
+
+# every file in pattern, once with the default parameters and once with random ones
+def file_cases(pattern, seed):
+    if os.path.isdir(pattern):
+        paths = sorted(glob.glob(os.path.join(pattern, '**', '*.scl'), recursive=True))
+    else:
+        paths = sorted(glob.glob(pattern, recursive=True))
+    rng = random.Random(seed)
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        label = os.path.splitext(os.path.basename(path))[0]
+        yield Case(label, data, None, 1, 69, 440.0)
+        yield Case(label, data, None, *random_params(rng))
+
+
+# --------------------------------------------------------
+# the implementations, each returns (sysex, frequencies or None)
+
+def run_engine(case, workspace):
+    text = mtsengine.decode_scala(case.data)
+    sysex = mtsengine.scl_to_syx(text, case.program_number, case.base_note, case.base_freq)
+    return sysex, mtsengine.scala_tuning(text, case.base_note, case.base_freq).freqs
+
+
+def run_session(case, workspace):
+    session = mtsengine.TuningSession(data=case.data, program_number=case.program_number, base_note=case.base_note, base_freq=case.base_freq)
+    return session.sysex, session.freqs
+
+
+def run_session_reuse(case, workspace):
+    session = mtsengine.TuningSession(data=case.data, program_number=(case.program_number + 1) % 128, base_note=(case.base_note + 7) % 128, base_freq=case.base_freq * 1.5)
+    session.sysex
+    session.base_note = case.base_note
+    session.sysex
+    session.base_freq = case.base_freq
+    session.sysex
+    session.program_number = case.program_number
+    return session.sysex, session.freqs
+
+
+def run_tables(case, workspace):
+    scale = mtsengine.parse_scala(mtsengine.decode_scala(case.data))
+    with warnings.catch_warnings():
+        # numpy warns about frequencies past the float range, which are clipped to the MIDI range anyway
+        warnings.simplefilter('ignore', RuntimeWarning)
+        scala_freqs, scala_freq_data = mtsengine.tuning_tables([scale], case.base_note, case.base_freq)
+    return mtsengine.build_sysex(scale.name, scala_freq_data[0], case.program_number), [float(freq) for freq in scala_freqs[0]]
+
+
+def run_tables_python(case, workspace):
+    # tuning_tables falls back to plain Python when numpy can't be loaded
+    load_numpy = mtsengine.load_numpy
+    mtsengine.load_numpy = lambda: None
+    try:
+        return run_tables(case, workspace)
+    finally:
+        mtsengine.load_numpy = load_numpy
+
+
+def stored_sysex(case, workspace, base_note, base_freq):
+    path = os.path.join(workspace, 'equivalence.store')
+    stored, failed = mtsstore.build_store([(case.label + '.scl', case.data)], path, base_note, base_freq)
+    if failed:
+        name, reason = failed[0]
+        raise Failure(reason.split(":")[0], reason)
+    store = mtsstore.ScaleStore(path)
+    try:
+        return store.sysex(store.find_content(case.data), case.program_number, case.base_note, case.base_freq), None
+    finally:
+        store.close()
+
+
+def run_store(case, workspace):
+    return stored_sysex(case, workspace, case.base_note, case.base_freq)
+
+
+def run_store_recompute(case, workspace):
+    return stored_sysex(case, workspace, 69, 440)
+
+
+def run_cli(case, workspace):
+    input_file = os.path.join(workspace, 'cli.scl')
+    output_file = os.path.join(workspace, 'cli.syx')
+    with open(input_file, 'wb') as f:
+        f.write(case.data)
+    input_file, output_file, status, detail, decoder, timings = scala2mts.convert_job((input_file, output_file, case.base_note, case.base_freq, case.program_number, 'always', False))
+    if status != 'written':
+        raise Failure(detail.split(":")[0], detail)
+    with open(output_file, 'rb') as f:
+        return f.read(), None
+
+
+# convert_scl_to_syx from the GUI, compiled on its own, since importing the GUI opens its window
+def load_gui_converter():
+    path = os.path.join(REPOSITORY_DIRECTORY, 'scala2mts-gui.py')
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), path)
+    functions = [node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name == 'convert_scl_to_syx']
+    namespace = {'os': os, 'mtsengine': mtsengine, 'print': lambda *args: None}
+    exec(compile(ast.Module(body=functions, type_ignores=[]), path, 'exec'), namespace)
+    return namespace['convert_scl_to_syx']
+
+
+def run_gui(case, workspace):
+    input_file = os.path.join(workspace, 'gui.scl')
+    output_file = os.path.join(workspace, 'gui.syx')
+    with open(input_file, 'wb') as f:
+        f.write(case.data)
+    if os.path.exists(output_file):
+        os.remove(output_file)
+    # the GUI passes the text of its entries
+    gui_converter(input_file, output_file, str(case.base_note), repr(case.base_freq), str(case.program_number))
+    with open(output_file, 'rb') as f:
+        return f.read(), None
+
+
+def run_web(case, workspace):
+    response = web.post('/', data={
+        'file': (io.BytesIO(case.data), case.label + '.scl'),
+        'program_number': str(case.program_number),
+        'base_note': str(case.base_note),
+        'base_freq': repr(case.base_freq),
+    })
+    if response.status_code == 400:
+        raise Failure('ScalaError', response.get_data(as_text=True))
+    if response.status_code != 200 or response.mimetype != 'application/octet-stream':
+        raise Failure('HTTP %d' % response.status_code, response.get_data(as_text=True)[:200])
+    return response.get_data(), None
+
+
+# --------------------------------------------------------
+# the reference, sharing nothing with the engine but its decoder and ScalaError
+
+REFERENCE_PRECISION = 40
+RATIO_PATTERN = re.compile(r'([0-9]+)(?:/([0-9]+))?')
+
+
+# the name, the description and the log2 of every pitch of a Scala file
+def reference_scale(text):
+    name = None
+    description = None
+    count = None
+    pitches = []
+    for line_number, line in enumerate(text.splitlines(), 1):
+        if line.startswith("!"):
+            if line_number == 1:
+                name = line.lstrip("!").strip()
+            continue
+        if description is None:
+            description = line.strip()
+            continue
+        words = line.split()
+        if count is None:
+            if not words or not re.fullmatch(r'[0-9]+', words[0]):
+                raise mtsengine.ScalaError(line_number, line, "no pitch count")
+            try:
+                count = int(words[0])
+            except ValueError:
+                raise mtsengine.ScalaError(line_number, line, "too many digits")
+            if count == 0:
+                raise mtsengine.ScalaError(line_number, line, "no pitches")
+            continue
+        if not words:
+            raise mtsengine.ScalaError(line_number, line, "no pitch")
+        value = words[0]
+        if "." in value:
+            try:
+                cents = Decimal(value)
+            except ArithmeticError:
+                raise mtsengine.ScalaError(line_number, line, "bad cents")
+            # the file format has no limit, but a program can only use cents a double can hold
+            if not cents.is_finite() or not math.isfinite(float(cents)):
+                raise mtsengine.ScalaError(line_number, line, "bad cents")
+            pitches.append(cents / 1200)
+        else:
+            match = RATIO_PATTERN.fullmatch(value)
+            try:
+                num, denom = (int(match.group(1)), int(match.group(2) or 1)) if match is not None else (0, 0)
+            except ValueError:
+                # more digits than int() reads
+                num = denom = 0
+            if num == 0 or denom == 0:
+                raise mtsengine.ScalaError(line_number, line, "bad ratio")
+            pitches.append((Decimal(num).ln() - Decimal(denom).ln()) / Decimal(2).ln())
+        if len(pitches) == count:
+            break
+    if count is None or len(pitches) < count:
+        raise mtsengine.ScalaError(0, "", "too few pitches")
+
+    if name is None:
+        name = description
+    name = name.split("/")[-1].replace(".scl", "")
+    return name[:16].encode('ascii', 'ignore').ljust(16), pitches
+
+
+def run_reference(case, workspace):
+    with localcontext() as context:
+        context.prec = REFERENCE_PRECISION
+        name, pitches = reference_scale(mtsengine.decode_scala(case.data))
+        log2_base = (Decimal(case.base_freq).ln() - Decimal(440).ln()) / Decimal(2).ln()
+
+        sysex = bytearray(b'\xf0\x7e\x00\x08\x01') + bytes([case.program_number]) + name
+        freqs = []
+        for note in range(128):
+            octave, degree = divmod(note - case.base_note, len(pitches))
+            semitones = 12 * (log2_base + octave * pitches[-1] + (pitches[degree - 1] if degree else 0))
+            # only compared within the MIDI range, where a float is plenty
+            try:
+                freqs.append(440 * 2.0**(float(semitones) / 12))
+            except OverflowError:
+                freqs.append(float('inf'))
+            # the MIDI note range, 0 to 127 semitones
+            position = min(max(69 + semitones, Decimal(0)), Decimal(127)) * 16384
+            position = int(position.quantize(Decimal(1), rounding=ROUND_HALF_EVEN))
+            sysex += bytes([position >> 14, (position >> 7) & 0x7F, position & 0x7F])
+
+    checksum = 0
+    for byte in sysex[1:]:
+        checksum ^= byte
+    sysex += bytes([checksum & 0x7F, 0xF7])
+    return bytes(sysex), freqs
+
+
+# (name, function, how many frequency data units its words may be off from engine's)
+IMPLEMENTATIONS = (
+    ('engine', run_engine, 0),
+    ('session', run_session, 0),
+    ('session-reuse', run_session_reuse, 0),
+    ('tables-numpy', run_tables, 0),
+    ('tables-python', run_tables_python, 0),
+    ('store', run_store, 0),
+    ('store-recompute', run_store_recompute, 0),
+    ('cli', run_cli, 0),
+    ('gui', run_gui, 0),
+    ('web', run_web, 0),
+    ('reference', run_reference, 1),
+)
+
+gui_converter = None
+web = None
+
+
+# the implementations that can run here, printing why any others can't
+def available_implementations(only, skip):
+    global gui_converter, web
+    implementations = []
+    for name, function, tolerance in IMPLEMENTATIONS:
+        if name != 'engine' and (name in skip or (only and name not in only)):
+            continue
+        if name == 'tables-numpy' and mtsengine.load_numpy() is None:
+            print("Skipping tables-numpy, numpy is not installed")
+            continue
+        if name == 'gui':
+            gui_converter = load_gui_converter()
+        if name == 'web':
+            try:
+                web = web_client()
+            except ImportError as e:
+                print("Skipping web, %s" % e)
+                continue
+        implementations.append((name, function, tolerance))
+    return implementations
+
+
+def run(function, case, workspace):
+    try:
+        sysex, freqs = function(case, workspace)
+        return Outcome('ok', sysex, freqs, None)
+    except (mtsengine.ScalaError, Failure) as e:
+        if isinstance(e, mtsengine.ScalaError) or e.kind == 'ScalaError':
+            return Outcome('rejected', None, None, str(e))
+        return Outcome('crashed', None, None, "%s: %s" % (e.kind, e))
+    except Exception as e:
+        return Outcome('crashed', None, None, "%s: %s" % (type(e).__name__, e))
+
+
+# --------------------------------------------------------
+# comparing
+
+def format_word(word):
+    position = (word[0] << 14) | (word[1] << 7) | word[2]
+    return "%02X %02X %02X (%.4f semitones, %.4f Hz)" % (word + (position / 16384, mtsengine.freq_data_to_hz(word)))
+
+
+# None if two outcomes are equivalent, otherwise what differs
+def compare(name, outcome, other_name, other, tolerance):
+    # a crash is a bug even when every implementation has it
+    for label, result in ((name, outcome), (other_name, other)):
+        if result.kind == 'crashed':
+            return "%s %s" % (label, describe_outcome(result))
+    if outcome.kind != other.kind:
+        return "%s %s, %s %s" % (name, describe_outcome(outcome), other_name, describe_outcome(other))
+    if outcome.kind != 'ok':
+        return None
+
+    for label, sysex in ((name, outcome.sysex), (other_name, other.sysex)):
+        if len(sysex) != mtsengine.BULK_DUMP_LENGTH:
+            return "%s wrote %d bytes instead of %d" % (label, len(sysex), mtsengine.BULK_DUMP_LENGTH)
+        if mtsengine.xor_bytes(sysex[1:mtsengine.CHECKSUM_OFFSET]) & 0x7F != sysex[mtsengine.CHECKSUM_OFFSET]:
+            return "%s wrote checksum %02X, its bytes add up to %02X" % (label, sysex[mtsengine.CHECKSUM_OFFSET], mtsengine.xor_bytes(sysex[1:mtsengine.CHECKSUM_OFFSET]) & 0x7F)
+
+    dump = next(mtsengine.iter_bulk_dumps(outcome.sysex))
+    other_dump = next(mtsengine.iter_bulk_dumps(other.sysex))
+    if outcome.sysex[:22] != other.sysex[:22]:
+        return "header, program or name: %s %r, %s %r" % (name, outcome.sysex[:22], other_name, other.sysex[:22])
+    for note, (word, other_word) in enumerate(zip(dump.freq_data, other_dump.freq_data)):
+        difference = abs(((word[0] - other_word[0]) << 14) + ((word[1] - other_word[1]) << 7) + word[2] - other_word[2])
+        if difference > tolerance:
+            return "note %d: %s %s, %s %s" % (note, name, format_word(word), other_name, format_word(other_word))
+    if tolerance == 0 and dump.checksum != other_dump.checksum:
+        return "checksum: %s %02X, %s %02X" % (name, dump.checksum, other_name, other_dump.checksum)
+
+    if outcome.freqs is not None and other.freqs is not None:
+        for note, (freq, other_freq) in enumerate(zip(outcome.freqs, other.freqs)):
+            # frequencies outside the MIDI range are clamped, and too large or small for a float anyway
+            if not mtsengine.MIN_FREQ <= other_freq <= mtsengine.MAX_FREQ:
+                continue
+            if abs(freq - other_freq) > FREQ_TOLERANCE * other_freq:
+                return "note %d: %s %r Hz, %s %r Hz" % (note, name, freq, other_name, other_freq)
+    return None
+
+
+def describe_outcome(outcome):
+    if outcome.kind == 'ok':
+        return "wrote a bulk dump"
+    return "%s (%s)" % ('rejected the file' if outcome.kind == 'rejected' else 'crashed', outcome.message)
+
+
+# the first disagreement with engine, as (implementation, what differs), or None
+def check_case(case, implementations, workspace):
+    baseline_name, baseline_function, tolerance = implementations[0]
+    baseline = run(baseline_function, case, workspace)
+    for name, function, tolerance in implementations[1:]:
+        difference = compare(baseline_name, baseline, name, run(function, case, workspace), tolerance)
+        if difference is not None:
+            return name, difference
+    return None
+
+
+# --------------------------------------------------------
+# shrinking
+
+# simpler versions of a pitch, simplest first
+def simpler_pitches(pitch):
+    if "." in pitch:
+        try:
+            cents = float(pitch)
+        except ValueError:
+            return []
+        if not math.isfinite(cents):
+            return []
+        candidates = ["%.1f" % round(cents), "%.1f" % cents, "%.3f" % cents]
+    else:
+        match = RATIO_PATTERN.fullmatch(pitch)
+        if match is None or not match.group(2):
+            return []
+        try:
+            num, denom = int(match.group(1)), int(match.group(2))
+        except ValueError:
+            return []
+        divisor = math.gcd(num, denom)
+        candidates = ["%d/%d" % (num // divisor, denom // divisor)] if divisor > 1 else []
+    return [candidate for candidate in candidates if len(candidate) < len(pitch)]
+
+
+# smaller versions of a case, most promising first
+def smaller_cases(case):
+    spec = case.spec
+    params = (case.program_number, case.base_note, case.base_freq)
+    pitches = spec.pitches
+    # halves first, then single pitches
+    for start, stop in [(0, len(pitches) // 2), (len(pitches) // 2, len(pitches) - 1)] + [(i, i + 1) for i in range(len(pitches))]:
+        if stop > start and stop - start < len(pitches):
+            yield make_case(case.label, spec._replace(pitches=pitches[:start] + pitches[stop:]), *params)
+    for i, pitch in enumerate(pitches):
+        for simpler in simpler_pitches(pitch):
+            yield make_case(case.label, spec._replace(pitches=pitches[:i] + [simpler] + pitches[i + 1:]), *params)
+    if spec.layout != PLAIN_LAYOUT:
+        yield make_case(case.label, spec._replace(layout=PLAIN_LAYOUT), *params)
+    if spec.description:
+        yield make_case(case.label, spec._replace(description=""), *params)
+    for changed in ((0, case.base_note, case.base_freq), (case.program_number, 69, case.base_freq), (case.program_number, case.base_note, 440.0), (case.program_number, case.base_note, float(round(case.base_freq)))):
+        if changed != params:
+            yield make_case(case.label, spec, *changed)
+
+
+# the smallest case found that still makes the same two implementations disagree
+def shrink(case, implementations, workspace, attempts=2000):
+    if case.spec is None:
+        # a file: start from its pitches, if those still show the mismatch
+        try:
+            scale = mtsengine.parse_scala(mtsengine.decode_scala(case.data))
+        except Exception:
+            return case
+        candidate = make_case(case.label, Spec(scale.description, list(scale.notes), PLAIN_LAYOUT), case.program_number, case.base_note, case.base_freq)
+        if check_case(candidate, implementations, workspace) is None:
+            return case
+        case = candidate
+
+    while attempts > 0:
+        for candidate in smaller_cases(case):
+            attempts -= 1
+            if check_case(candidate, implementations, workspace) is not None:
+                case = candidate
+                break
+            if attempts <= 0:
+                break
+        else:
+            break
+    return case
+
+
+def report(case, name, difference):
+    print("Mismatch between engine and %s on %s (program %d, base note %d, base frequency %r):" % (name, case.label, case.program_number, case.base_note, case.base_freq))
+    print("    " + difference)
+
+
+# --------------------------------------------------------
+
+def main(argv):
+    count = 1000
+    seed = 0
+    files_pattern = os.path.join(BENCHMARK_DIRECTORY, 'corpus')
+    only = set()
+    skip = set()
+    output_file = None
+    shrinking = True
+    verbose = False
+
+    try:
+        opts, args = getopt.getopt(argv, "hn:f:o:v", ["help", "count=", "seed=", "files=", "only=", "skip=", "output=", "no-shrink", "verbose"])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print(__doc__)
+            sys.exit()
+        elif o in ("-n", "--count"):
+            count = int(a)
+        elif o == "--seed":
+            seed = int(a)
+        elif o in ("-f", "--files"):
+            files_pattern = a
+        elif o == "--only":
+            only = set(a.split(","))
+        elif o == "--skip":
+            skip = set(a.split(","))
+        elif o in ("-o", "--output"):
+            output_file = a
+        elif o == "--no-shrink":
+            shrinking = False
+        elif o in ("-v", "--verbose"):
+            verbose = True
+
+    unknown = (only | skip) - set(name for name, function, tolerance in IMPLEMENTATIONS)
+    if unknown:
+        print("Unknown implementations: " + ", ".join(sorted(unknown)))
+        sys.exit(2)
+
+    implementations = available_implementations(only, skip)
+    print("Comparing " + ", ".join(name for name, function, tolerance in implementations))
+
+    checked = 0
+    with tempfile.TemporaryDirectory() as workspace:
+        for case in list(file_cases(files_pattern, seed)) + list(random_cases(count, seed)):
+            if verbose:
+                print("%s, program %d, base note %d, base frequency %r" % (case.label, case.program_number, case.base_note, case.base_freq))
+            mismatch = check_case(case, implementations, workspace)
+            if mismatch is None:
+                checked += 1
+                continue
+
+            print("%d scales agreed" % checked)
+            report(case, *mismatch)
+            if shrinking:
+                name = mismatch[0]
+                # only the two that disagree need to run while shrinking
+                pair = [implementation for implementation in implementations if implementation[0] in ('engine', name)]
+                case = shrink(case, pair, workspace)
+                print()
+                print("Minimal reproducer:")
+                report(case, *check_case(case, pair, workspace))
+            print()
+            print(case.data.decode('latin-1'), end="")
+            if output_file is not None:
+                with open(output_file, 'wb') as f:
+                    f.write(case.data)
+                print()
+                print("Wrote " + output_file)
+                print("python scala2mts.py -i %s -n %d -f %r -p %d" % (output_file, case.base_note, case.base_freq, case.program_number))
+            sys.exit(1)
+
+    print("%d scales, all %d implementations agree" % (checked, len(implementations)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
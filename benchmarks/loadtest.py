@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# Path: benchmarks/loadtest.py
+# Author: Olle Holmberg, 2022-2023
+# License: GPL v3
+#
+# https://github.com/unremarkablegarden/scala2mts
+
+
+"""
+Load test the web app locally: start vercel/api/index.py under a WSGI
+server with several worker processes, send it a mix of Scala file uploads
+at a fixed rate, and report the latency percentiles, errors and throughput.
+Everything runs on this machine, nothing is downloaded. Linux only, the
+workers are forked.
+
+python benchmarks/loadtest.py [-w workers] [-r rate] [-d duration] [options]
+
+-w workers: worker processes of the server, one request at a time each (default: 4)
+-r rate: requests per second to send (default: 50)
+-d duration: seconds to send requests for (default: 10)
+-c connections: most requests in flight at once (default: 64)
+-f files: a directory or glob of Scala files to upload (default: benchmarks/corpus)
+    and synthetic scales of 5, 12, 100 and 1000 notes
+--invalid fraction: share of uploads that are broken on purpose and expected
+    to get a 400 (default: 0.05)
+--url url: test a server that is already running instead, e.g. http://127.0.0.1:5000/
+--warm: send a few requests to every worker before the test, so the workers'
+    first requests (which import Flask, like on a cold start) aren't measured
+--seed n: the seed of the random mix, the same seed sends the same requests (default: 0)
+-o output: save the report as JSON
+
+Requests are sent on schedule whether or not the earlier ones have been
+answered, and latency counts from when a request was due, so a server that
+falls behind shows it in the percentiles instead of slowing down the test.
+
+The exit status is 1 if any request failed unexpectedly (a 5xx, a timeout,
+a refused connection, or a 4xx for a valid upload).
+"""
+
+import os
+import sys
+import glob
+import json
+import math
+import time
+import random
+import signal
+import getopt
+import threading
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+API_DIRECTORY = os.path.join(BENCHMARK_DIRECTORY, '..', 'vercel', 'api')
+sys.path.insert(0, BENCHMARK_DIRECTORY)
+
+from benchmark import synthetic_scale, SYNTHETIC_SIZES
+
+BOUNDARY = 'scala2mts-loadtest-boundary'
+
+
+# --------------------------------------------------------
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+# start a WSGI server for the web app with workers forked processes sharing one socket,
+# returns (url, list of worker pids)
+def start_server(workers):
+    sys.path.insert(0, API_DIRECTORY)
+    from index import app
+
+    server = make_server('127.0.0.1', 0, app, handler_class=QuietRequestHandler)
+    server.socket.listen(128)
+    pids = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # each worker imports Flask on its first conversion, like a fresh instance
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    server.socket.close()
+    return 'http://127.0.0.1:%d/' % server.server_address[1], pids
+
+
+def stop_server(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+
+# --------------------------------------------------------
+
+# (name, bytes) of every Scala file to upload
+def load_files(pattern):
+    if os.path.isdir(pattern):
+        paths = sorted(glob.glob(os.path.join(pattern, '**', '*.scl'), recursive=True))
+    else:
+        paths = sorted(glob.glob(pattern, recursive=True))
+    files = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            files.append((os.path.basename(path), f.read()))
+    for count in SYNTHETIC_SIZES:
+        for kind in ('ratios', 'cents'):
+            files.append(("synthetic-%d-%s.scl" % (count, kind), synthetic_scale(count, kind)))
+    return files
+
+
+def multipart_body(file_name, data, fields):
+    parts = []
+    for name, value in fields.items():
+        parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (BOUNDARY, name, value)).encode())
+    parts.append(('--%s\r\nContent-Disposition: form-data; name="file"; filename="%s"\r\nContent-Type: application/octet-stream\r\n\r\n' % (BOUNDARY, file_name)).encode())
+    parts.append(data)
+    parts.append(('\r\n--%s--\r\n' % BOUNDARY).encode())
+    return b''.join(parts)
+
+
+# the requests to send, a list of (label, body, expected status)
+def request_mix(files, count, invalid, seed):
+    rng = random.Random(seed)
+    requests = []
+    for i in range(count):
+        file_name, data = rng.choice(files)
+        fields = {
+            'base_note': rng.randint(36, 84),
+            'base_freq': "%.3f" % rng.uniform(200, 500),
+            'program_number': rng.randint(0, 127),
+        }
+        expected = 200
+        if rng.random() < invalid:
+            # the count line says there are more pitches than there are
+            file_name, data, expected = "broken.scl", b"! broken.scl\n!\nBroken\n 12\n!\n 100.0\n", 400
+        requests.append((file_name, multipart_body(file_name, data, fields), expected))
+    return requests
+
+
+# --------------------------------------------------------
+
+def send_request(url, body, expected, due):
+    parsed = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=30)
+    try:
+        connection.request('POST', parsed.path or '/', body, {'Content-Type': 'multipart/form-data; boundary=' + BOUNDARY})
+        response = connection.getresponse()
+        response.read()
+        status = response.status
+    except Exception as e:
+        status = type(e).__name__
+    finally:
+        connection.close()
+    return status, expected, time.perf_counter() - due
+
+
+def run_load(url, requests, rate, connections):
+    results = []
+    lock = threading.Lock()
+
+    def record(future):
+        with lock:
+            results.append(future.result())
+
+    executor = ThreadPoolExecutor(max_workers=connections)
+    start = time.perf_counter()
+    for i, (label, body, expected) in enumerate(requests):
+        due = start + i / rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        executor.submit(send_request, url, body, expected, due).add_done_callback(record)
+    executor.shutdown(wait=True)
+    return results, time.perf_counter() - start
+
+
+# nearest rank percentile of a sorted list
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(results, elapsed, rate, workers):
+    latencies = sorted(latency for status, expected, latency in results)
+    statuses = {}
+    failed = 0
+    for status, expected, latency in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        if status != expected:
+            failed += 1
+    return {
+        'workers': workers,
+        'target_rate': rate,
+        'requests': len(results),
+        'seconds': elapsed,
+        'requests_per_second': len(results) / elapsed if elapsed else 0.0,
+        'failed': failed,
+        'statuses': statuses,
+        'latency_ms': {
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'max': latencies[-1] * 1000 if latencies else 0.0,
+        },
+    }
+
+
+def print_report(report):
+    print("%d requests in %.1f s, %.1f requests/s (target %.1f), %s workers" % (report['requests'], report['seconds'], report['requests_per_second'], report['target_rate'], report['workers']))
+    print("latency p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, max %.1f ms" % tuple(report['latency_ms'][key] for key in ('p50', 'p95', 'p99', 'max')))
+    print("responses: " + ", ".join("%s %d" % item for item in sorted(report['statuses'].items())))
+    print("%d unexpected failures" % report['failed'])
+
+
+def main(argv):
+    workers = 4
+    rate = 50.0
+    duration = 10.0
+    connections = 64
+    files_pattern = os.path.join(BENCHMARK_DIRECTORY, 'corpus')
+    invalid = 0.05
+    url = None
+    seed = 0
+    output_file = None
+    warm = False
+
+    try:
+        opts, args = getopt.getopt(argv, "hw:r:d:c:f:o:", ["help", "workers=", "rate=", "duration=", "connections=", "files=", "invalid=", "url=", "seed=", "output=", "warm"])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print(__doc__)
+            sys.exit()
+        elif o in ("-w", "--workers"):
+            workers = int(a)
+        elif o in ("-r", "--rate"):
+            rate = float(a)
+        elif o in ("-d", "--duration"):
+            duration = float(a)
+        elif o in ("-c", "--connections"):
+            connections = int(a)
+        elif o in ("-f", "--files"):
+            files_pattern = a
+        elif o == "--invalid":
+            invalid = float(a)
+        elif o == "--url":
+            url = a
+        elif o == "--seed":
+            seed = int(a)
+        elif o == "--warm":
+            warm = True
+        elif o in ("-o", "--output"):
+            output_file = a
+
+    files = load_files(files_pattern)
+    requests = request_mix(files, max(1, int(rate * duration)), invalid, seed)
+
+    pids = []
+    if url is None:
+        url, pids = start_server(workers)
+    else:
+        workers = "external"
+    try:
+        if warm:
+            # all at once, so every worker gets some
+            warmup = request_mix(files, 4 * (workers if pids else 4), 0, seed + 1)
+            run_load(url, warmup, 1000.0, len(warmup))
+        results, elapsed = run_load(url, requests, rate, connections)
+    finally:
+        stop_server(pids)
+
+    report = summarize(results, elapsed, rate, workers)
+    print_report(report)
+    if output_file is not None:
+        with open(output_file, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Wrote " + output_file)
+    sys.exit(1 if report['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
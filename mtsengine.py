@@ -0,0 +1,1183 @@
+# Path: mtsengine.py
+# Author: Olle Holmberg, 2022-2023
+# License: GPL v3
+#
+# https://github.com/unremarkablegarden/scala2mts
+#
+# Reference: https://musescore.org/sites/musescore.org/files/2018-06/midituning.pdf
+
+
+"""
+Conversion engine shared by the command line tool, the GUI and the web app.
+
+The pipeline is split into stages that can be called one by one:
+
+    decode_scala      bytes -> text (ASCII, UTF-8, CP1252, chardet as a last resort)
+    parse_scala       text -> Scale(name, description, notes_per_octave, notes)
+    scale_to_cents    notes -> cents
+    cents_to_ratios   cents -> ratios (with 1/1 prepended)
+    tuning_frequencies ratios -> 128 frequencies
+    tuning_tables     many scales -> N x 128 frequencies and N x 128 x 3 words
+    hz_to_freq_data   frequency -> MTS frequency data word (xx, yy, zz)
+    build_sysex       name + words + program number -> SysEx bytes
+    build_bank        SysEx dumps + program numbers -> one multi-program file
+    build_note_changes changed notes -> real-time single note tuning changes
+    scale_octave_tuning 12 note 2/1 tunings -> scale/octave tuning message
+    iter_bulk_dumps   .syx bytes -> program number, name, 128 words (and back to .scl)
+
+scl_to_syx() runs all of them, TuningSession keeps the result of each stage
+while parameters change. Importing this module has no side effects.
+"""
+
+import os
+import math
+import time
+import functools
+from fractions import Fraction
+from collections import namedtuple, Counter
+
+# numpy is optional, it is only used to compute the tuning tables of many scales at once,
+# and only imported when that happens, as importing it takes longer than converting a scale
+@functools.lru_cache(maxsize=None)
+def load_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+# lowest and highest frequency that can be expressed in a MIDI tuning dump
+MIN_FREQ = 8.1757989156
+MAX_FREQ = 12543.853951
+
+Scale = namedtuple('Scale', ['name', 'description', 'notes_per_octave', 'notes'])
+Tuning = namedtuple('Tuning', ['scale', 'cents', 'ratios', 'freqs', 'freq_data'])
+
+
+# --------------------------------------------------------
+
+# chardet only looks at this many bytes, a Scala file's encoding shows in its comments and description
+CHARDET_PREFIX = 4096
+
+BYTE_ORDER_MARKS = ((b'\xef\xbb\xbf', 'utf-8-sig'), (b'\xff\xfe', 'utf-16'), (b'\xfe\xff', 'utf-16'))
+
+# how often each decoder was used, to measure the fast path hit rate
+decoder_counts = Counter()
+
+
+# decode the bytes of a Scala file, returns the text and the name of the decoder that was used
+# almost all Scala files are ASCII or UTF-8, and most of the rest are Latin-1 / CP1252,
+# so chardet is only imported and run when none of those fit
+def decode_scala_with_decoder(data):
+    text = None
+    decoder = None
+    for bom, bom_decoder in BYTE_ORDER_MARKS:
+        if data.startswith(bom):
+            try:
+                text = data.decode(bom_decoder)
+                decoder = bom_decoder
+            except UnicodeDecodeError:
+                # the rest isn't what the BOM says, decode it like a file without one
+                data = data[len(bom):]
+            break
+
+    if decoder is None:
+        try:
+            text = data.decode('ascii')
+            decoder = 'ascii'
+        except UnicodeDecodeError:
+            pass
+    if decoder is None:
+        try:
+            text = data.decode('utf-8')
+            decoder = 'utf-8'
+        except UnicodeDecodeError:
+            pass
+    if decoder is None and b'\x00' not in data:
+        # non-latin text is mostly high bytes, western text only has a few accented letters and quotes
+        high_bytes = sum(1 for byte in data if byte >= 0x80)
+        if high_bytes * 4 <= len(data):
+            try:
+                text = data.decode('cp1252')
+                decoder = 'cp1252' if any(0x80 <= byte < 0xA0 for byte in data) else 'latin-1'
+            except UnicodeDecodeError:
+                pass
+    if decoder is None:
+        import chardet
+        file_encoding = chardet.detect(data[:CHARDET_PREFIX])['encoding'] or 'latin-1'
+        text = data.decode(file_encoding, errors='replace')
+        decoder = 'chardet:' + file_encoding
+
+    decoder_counts[decoder] += 1
+    return text, decoder
+
+
+def decode_scala(data):
+    return decode_scala_with_decoder(data)[0]
+
+
+def read_scala_file(path, timer=None):
+    if timer is not None:
+        timer.restart()
+    # Open the file in binary mode to avoid decoding errors
+    with open(path, 'rb') as f:
+        data = f.read()
+    text = decode_scala(data)
+    if timer is not None:
+        timer.lap('decode')
+    return text
+
+
+# --------------------------------------------------------
+
+"""
+Scala file format (https://www.huygens-fokker.org/scala/scl_format.html)
+
+        ! name.scl            lines starting with ! are comments, anywhere
+        !
+        description           the first line that isn't a comment, may be empty
+         12                   the number of pitches
+        !
+         28/27                one pitch per line, leading whitespace allowed
+         203.91               anything after the value is ignored
+         2                    a value with a . is in cents, otherwise it's a
+        ...                   ratio, and an integer n is the ratio n/1
+
+Lines after the last pitch are ignored.
+"""
+
+
+class ScalaError(ValueError):
+    """
+    A Scala file that can't be parsed, with the line it went wrong on.
+    """
+
+    def __init__(self, line_number, line, reason):
+        self.line_number = line_number
+        self.line = line
+        self.reason = reason
+        super().__init__("line %d: %s (%r)" % (line_number, reason, line))
+
+
+# a whole number in ASCII digits, str.isdigit() alone also accepts digits like ² that int() can't read
+def is_whole_number(word):
+    return word.isascii() and word.isdigit()
+
+
+# a pitch value, the first word of a pitch line, returns the value as written
+def parse_pitch(value, line_number, line):
+    if "." in value:
+        try:
+            cents = float(value)
+        except ValueError:
+            raise ScalaError(line_number, line, "%s is not a valid cents value" % value)
+        if not math.isfinite(cents):
+            raise ScalaError(line_number, line, "%s is too large a cents value" % value)
+        return value
+
+    num, slash, denom = value.partition("/")
+    if not is_whole_number(num) or (slash and not is_whole_number(denom)):
+        raise ScalaError(line_number, line, "%s is not a valid number or ratio" % value)
+    try:
+        if int(num) == 0 or (slash and int(denom) == 0):
+            raise ScalaError(line_number, line, "%s is not a positive ratio" % value)
+    except ValueError:
+        # past the number of digits int() reads
+        raise ScalaError(line_number, line, "%s has too many digits" % value)
+    return value
+
+
+# read the lines of a Scala file in one pass,
+# yielding (line number, kind, value) where kind is 'name', 'description', 'count' or 'pitch'
+def tokenize_scala(lines):
+    description = None
+    count = None
+    pitches = 0
+    line_number = 0
+
+    for line_number, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+
+        if line.startswith("!"):
+            # by convention the first comment holds the file name
+            if line_number == 1:
+                yield line_number, 'name', line.lstrip("!").strip()
+            continue
+
+        if description is None:
+            description = line.strip()
+            yield line_number, 'description', description
+            continue
+
+        words = line.split()
+        if count is None:
+            if not words or not is_whole_number(words[0]):
+                raise ScalaError(line_number, line, "expected the number of pitches")
+            try:
+                count = int(words[0])
+            except ValueError:
+                raise ScalaError(line_number, line, "%s has too many digits" % words[0])
+            yield line_number, 'count', count
+        else:
+            if not words:
+                raise ScalaError(line_number, line, "expected a pitch")
+            pitches += 1
+            yield line_number, 'pitch', parse_pitch(words[0], line_number, line)
+
+        if pitches == count:
+            return
+
+    if count is None:
+        raise ScalaError(line_number, "", "the file ends before the number of pitches")
+    raise ScalaError(line_number, "", "expected %d pitches, found %d" % (count, pitches))
+
+
+def parse_scala(text):
+    lines = text.splitlines() if isinstance(text, str) else text
+
+    scala_name = None
+    scala_description = ""
+    notes_per_octave = 0
+    scala_notes = []
+    for line_number, kind, value in tokenize_scala(lines):
+        if kind == 'name':
+            scala_name = value
+        elif kind == 'description':
+            scala_description = value
+        elif kind == 'count':
+            notes_per_octave = value
+        else:
+            scala_notes.append(value)
+
+    if notes_per_octave == 0:
+        raise ScalaError(line_number, "", "a scale needs at least one pitch")
+
+    # without a file name comment, use the description
+    if scala_name is None:
+        scala_name = scala_description
+
+    # remove full path, if it exists
+    if "/" in scala_name:
+        scala_name = scala_name.split('/')[-1]
+
+    # remove the .scl extension
+    scala_name = scala_name.replace(".scl", "")
+
+    return Scale(scala_name, scala_description, notes_per_octave, scala_notes)
+
+
+# --------------------------------------------------------
+
+# function to calculate ratio of cents
+def cents_to_ratio(cents):
+    try:
+        return 2**(cents / 1200)
+    except OverflowError:
+        # far past the MIDI range, its notes are clamped like in note_to_hz
+        return math.inf
+
+
+# --------------------------------------------------------
+# exact ratios, for just intonation scales
+
+# just intonation ratios are almost always made of small primes,
+# their log2 is a sum of cached log2(p) with integer exponents
+PRIME_BASIS = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47)
+LOG2_PRIMES = tuple(math.log2(prime) for prime in PRIME_BASIS)
+PRIME_BASIS_PRODUCT = math.prod(PRIME_BASIS)
+
+# the archive reuses a few hundred ratios thousands of times, these caches are shared by every scale
+RATIO_CACHE_SIZE = 4096
+
+
+# "6/4" -> (3, 2), "2" -> (2, 1), None for cents
+# the reduced integers, for everything that only needs the log2 and not a Fraction
+@functools.lru_cache(maxsize=RATIO_CACHE_SIZE)
+def parse_ratio_integers(note):
+    if "." in note:
+        return None
+    num, slash, denom = note.partition("/")
+    num = int(num)
+    denom = int(denom) if slash else 1
+    divisor = math.gcd(num, denom)
+    return num // divisor, denom // divisor
+
+
+# "3/2" -> Fraction(3, 2), "2" -> Fraction(2, 1), None for cents
+@functools.lru_cache(maxsize=RATIO_CACHE_SIZE)
+def parse_ratio(note):
+    integers = parse_ratio_integers(note)
+    if integers is None:
+        return None
+    return Fraction(*integers)
+
+
+# the exponents of num/denom over PRIME_BASIS, or None if it has a bigger prime factor
+def factor_ratio(num, denom):
+    # a bigger prime factor shows up after a few gcds, without trial division by every prime
+    for value in (num, denom):
+        divisor = math.gcd(value, PRIME_BASIS_PRODUCT)
+        while divisor > 1:
+            value //= divisor
+            divisor = math.gcd(value, divisor)
+        if value != 1:
+            return None
+
+    exponents = []
+    for prime in PRIME_BASIS:
+        # most ratios are done after 2, 3 and 5, the rest of the exponents are 0
+        if num == 1 and denom == 1:
+            return tuple(exponents) + (0,) * (len(PRIME_BASIS) - len(exponents))
+        exponent = 0
+        while num % prime == 0:
+            num //= prime
+            exponent += 1
+        while denom % prime == 0:
+            denom //= prime
+            exponent -= 1
+        exponents.append(exponent)
+    return tuple(exponents)
+
+
+# cached on the integers, hashing a Fraction is much slower
+@functools.lru_cache(maxsize=RATIO_CACHE_SIZE)
+def _ratio_log2(num, denom):
+    exponents = factor_ratio(num, denom)
+    if exponents is None:
+        return math.log2(num) - math.log2(denom)
+    return math.fsum(exponent * log2 for exponent, log2 in zip(exponents, LOG2_PRIMES) if exponent)
+
+
+# log2 of an exact ratio
+def ratio_log2(ratio):
+    return _ratio_log2(ratio.numerator, ratio.denominator)
+
+
+# the cents of one note of a scale, memoized across all scales
+@functools.lru_cache(maxsize=RATIO_CACHE_SIZE)
+def note_to_cents(note):
+    integers = parse_ratio_integers(note)
+    if integers is None:
+        return float(note)
+    return 1200 * _ratio_log2(*integers)
+
+
+# --------------------------------------------------------
+
+# convert the raw note strings of a scale to cents
+# values with a . are cents, everything else is a ratio or an integer n meaning n/1
+def scale_to_cents(scala_notes):
+    return [note_to_cents(note) for note in scala_notes]
+
+
+# the exact ratios of a scale with the 1/1 first, or None if any note is in cents
+def scale_to_ratios(scala_notes):
+    scala_ratios = [Fraction(1)]
+    for note in scala_notes:
+        ratio = parse_ratio(note)
+        if ratio is None:
+            return None
+        scala_ratios.append(ratio)
+    return scala_ratios
+
+
+# convert cents to ratios, with the 1/1 of the base note at the start of the list
+# if the notes are given and they are all ratios, the exact ratios are used instead
+def cents_to_ratios(scala_cents, scala_notes=None):
+    if scala_notes is not None:
+        scala_ratios = scale_to_ratios(scala_notes)
+        if scala_ratios is not None:
+            return scala_ratios
+    scala_ratios = [cents_to_ratio(cents) for cents in scala_cents]
+    scala_ratios.insert(0, 1)
+    return scala_ratios
+
+
+# --------------------------------------------------------
+
+# function to calculate frequency of note, based on base note and base frequency, using scala_ratios between notes, and the notes per octave
+def note_to_hz(note, base_note, base_freq, scala_ratios, notes_per_octave):
+    # calculate the note number within the octave
+    note_in_octave = (note - base_note) % notes_per_octave
+    # calculate the ratio of the note
+    ratio = scala_ratios[note_in_octave]
+    # calculate the octave of the note
+    octave = (note - base_note) // notes_per_octave
+    octave_size = scala_ratios[notes_per_octave]
+    # calculate the frequency of the note
+    try:
+        return base_freq * (octave_size**octave) * ratio
+    except (OverflowError, ZeroDivisionError):
+        # far past the MIDI range, hz_to_freq_data clamps it like any other note out of range
+        return math.inf
+
+
+# calculate frequencies of all 128 MIDI notes
+# with the cents of the scale, the ratios are worked out from the cents instead, like tuning_tables does,
+# so pitches too far out for a float ratio still give the right notes and exact ratios aren't factored twice
+def tuning_frequencies(scala_ratios, notes_per_octave, base_note=69, base_freq=440, scala_cents=None):
+    if scala_cents is not None:
+        return log2_tuning_frequencies([0.0] + [cents / 1200 for cents in scala_cents], notes_per_octave, base_note, base_freq)
+    if all(isinstance(ratio, Fraction) for ratio in scala_ratios):
+        return exact_tuning_frequencies(scala_ratios, notes_per_octave, base_note, base_freq)
+    return [note_to_hz(i, base_note, base_freq, scala_ratios, notes_per_octave) for i in range(0, 128)]
+
+
+# same as note_to_hz for exact ratios, the octaves are added in log2 space
+# instead of raising a float period to a power, so the only rounding is in the final 2**x
+def exact_tuning_frequencies(scala_ratios, notes_per_octave, base_note=69, base_freq=440):
+    return log2_tuning_frequencies([ratio_log2(ratio) for ratio in scala_ratios], notes_per_octave, base_note, base_freq)
+
+
+# the 128 frequencies from the log2 of each ratio, 1/1 first
+def log2_tuning_frequencies(log2_ratios, notes_per_octave, base_note=69, base_freq=440):
+    log2_period = log2_ratios[notes_per_octave]
+    scala_freqs = []
+    for note in range(0, 128):
+        octave, note_in_octave = divmod(note - base_note, notes_per_octave)
+        try:
+            scala_freqs.append(base_freq * 2.0**(octave * log2_period + log2_ratios[note_in_octave]))
+        except OverflowError:
+            scala_freqs.append(math.inf)
+    return scala_freqs
+
+
+# --------------------------------------------------------
+
+"""
+Frequency data format
+
+xx = semitone (MIDI note number to retune to, unit is 100 cents)
+yy = MSB of fractional part (1/128 semitone = 100/128 cents = .78125 cent units)
+zz = LSB of fractional part (1/16384 semitone = 100/16384 cents = .0061 cent units)
+
+Frequency data shall be sent via system exclusive messages. Because system exclusive data bytes have their high bit set low, containing 7 bits of data, a 3-byte (21-bit) "frequency data word" is used for specifying a frequency with the suggested resolution.
+
+The first byte of the frequency data word specifies the nearest equal-tempered semitone below the frequency.
+
+The next two bytes (14 bits) specify the fraction of 100 cents above the semitone at which the frequency lies.
+"""
+
+# the largest frequency data word, 7F 7F 7F means "no change" and can't be used
+MAX_FREQ_DATA_POSITION = (127 << 14) | 0x3FFE
+
+
+# function to convert frequency to frequency data
+# the position above MIDI note 0 is computed once in 1/16384 semitone units,
+# the semitone is its top 7 bits and the fraction its low 14 bits
+def hz_to_freq_data(freq):
+    # limit freq to bounds of MIDI note range
+    if freq < MIN_FREQ:
+        freq = MIN_FREQ
+    elif freq > MAX_FREQ:
+        freq = MAX_FREQ
+
+    position = round((69 + 12 * math.log2(freq / 440)) * 16384)
+    if position < 0:
+        position = 0
+    elif position > MAX_FREQ_DATA_POSITION:
+        position = MAX_FREQ_DATA_POSITION
+
+    return (position >> 14, (position >> 7) & 0x7F, position & 0x7F)
+
+
+# verify a frequency data encoder against a high precision reference,
+# over steps_per_note frequencies for every MIDI note, returns the largest error in cents
+def verify_freq_data(encoder=hz_to_freq_data, steps_per_note=64):
+    from decimal import Decimal, localcontext
+
+    max_error = 0.0
+    with localcontext() as context:
+        context.prec = 40
+        ln2 = Decimal(2).ln()
+        for step in range(127 * steps_per_note + 1):
+            # the golden ratio spreads the samples off the 1/16384 semitone grid
+            note = (step + (step * 0.6180339887498949) % 1) / steps_per_note
+            freq = 440 * 2**((note - 69) / 12)
+            if not MIN_FREQ <= freq <= MAX_FREQ:
+                continue
+            cents = Decimal(1200) * (Decimal(freq) / 440).ln() / ln2 + 6900
+            error = abs(float(cents - Decimal(freq_data_to_cents(encoder(freq)))))
+            max_error = max(max_error, error)
+    return max_error
+
+
+# --------------------------------------------------------
+
+# repeat a single base note or base frequency for every scale in a batch
+def _per_scale(value, count):
+    if isinstance(value, (int, float)):
+        return [value] * count
+    value = list(value)
+    if len(value) != count:
+        raise ValueError("Expected %d values, got %d" % (count, len(value)))
+    return value
+
+
+# calculate the frequencies and frequency data words of a batch of parsed scales
+# returns an N x 128 frequency matrix and an N x 128 x 3 uint8 word array
+# (lists of lists when numpy isn't installed)
+def tuning_tables(scales, base_notes=69, base_freqs=440):
+    count = len(scales)
+    base_notes = _per_scale(base_notes, count)
+    base_freqs = _per_scale(base_freqs, count)
+
+    np = load_numpy()
+    if np is None:
+        scala_freqs = []
+        scala_freq_data = []
+        for scale, base_note, base_freq in zip(scales, base_notes, base_freqs):
+            scale_cents = scale_to_cents(scale.notes)
+            scala_ratios = cents_to_ratios(scale_cents, scale.notes)
+            freqs = tuning_frequencies(scala_ratios, scale.notes_per_octave, base_note, base_freq, scale_cents)
+            scala_freqs.append(freqs)
+            scala_freq_data.append([hz_to_freq_data(freq) for freq in freqs])
+        return scala_freqs, scala_freq_data
+
+    # all scales in one matrix, padded to the longest scale, with the 1/1 in the first column
+    scala_cents = [scale_to_cents(scale.notes) for scale in scales]
+    width = max([len(cents) for cents in scala_cents] + [0]) + 1
+    cents = np.zeros((count, width))
+    for i, row in enumerate(scala_cents):
+        cents[i, 1:len(row) + 1] = row
+    log2_ratios = cents / 1200
+
+    notes_per_octave = np.array([scale.notes_per_octave for scale in scales], dtype=np.int64).reshape(count, 1)
+    if (notes_per_octave <= 0).any():
+        raise ValueError("Every scale needs at least one note per octave")
+    base_notes = np.array(base_notes, dtype=np.int64).reshape(count, 1)
+    base_freqs = np.array(base_freqs, dtype=np.float64).reshape(count, 1)
+
+    # same as log2_tuning_frequencies, for every note of every scale
+    steps = np.arange(128).reshape(1, 128) - base_notes
+    note_in_octave = steps % notes_per_octave
+    octave = steps // notes_per_octave
+    log2_ratio = np.take_along_axis(log2_ratios, note_in_octave, axis=1)
+    log2_period = np.take_along_axis(log2_ratios, notes_per_octave, axis=1)
+    # notes past the float range become inf, and are clipped to the MIDI range like the others
+    with np.errstate(over='ignore'):
+        scala_freqs = base_freqs * 2.0**(octave * log2_period + log2_ratio)
+
+    return scala_freqs, freqs_to_freq_data(scala_freqs)
+
+
+# same as hz_to_freq_data, for an array of frequencies, returns uint8 words in an extra last axis
+def freqs_to_freq_data(freqs):
+    np = load_numpy()
+    freqs = np.clip(freqs, MIN_FREQ, MAX_FREQ)
+    position = np.rint((69 + 12 * np.log2(freqs / 440)) * 16384).astype(np.int64)
+    position = np.clip(position, 0, MAX_FREQ_DATA_POSITION)
+    return np.stack([position >> 14, (position >> 7) & 0x7F, position & 0x7F], axis=-1).astype(np.uint8)
+
+
+# --------------------------------------------------------
+
+"""
+The format of the SysEx dump is as follows:
+
+        header = F0 7E 00 08 01 tt tn
+        tuning_data = <xx yy zz> * 128
+        footer = ck F7
+
+where
+
+        F0 7E = universal non-realtime SysEx header
+        00    = target device ID
+        08    = sub-ID #1 (MIDI tuning standard)
+        01    = sub-ID #2 (bulk dump reply)
+        tt    = tuning program number 0 to 127 in hexadecimal
+        tn    = tuning name (16 ASCII characters)
+        <xx yy zz>    = frequency data for one note,
+                        repeated 128 times, one for each MIDI note number
+        ck    = checksum (XOR of 7E 00 08 01 tt <388 bytes>)
+        F7    = end of SysEx message
+
+Dump messages the checksum field is calculated by successively XOR'ing the bytes in the message, excluding the F0, F7, and the checksum field... The resulting value is then AND'ed with 7F, to create a 7 bit value.
+"""
+
+BULK_DUMP_HEADER = b'\xf0\x7e\x00\x08\x01'
+BULK_DUMP_LENGTH = 408
+
+
+# limit scala name to 16 ASCII characters, padded with spaces
+def tuning_name(scala_name):
+    scala_name = scala_name[:16]
+    scala_name = scala_name.encode('ascii', 'ignore').decode('utf-8')
+    return scala_name.ljust(16)
+
+
+# assemble the bulk tuning dump from the name, the 128 frequency data words and the program number
+def build_sysex(scala_name, scala_freq_data, program_number):
+    if not 0 <= program_number <= 127:
+        raise ValueError("Program number must be between 0 and 127, not %s" % program_number)
+
+    sysex = bytearray(BULK_DUMP_LENGTH)
+    view = memoryview(sysex)
+
+    # header, everything after the F0 counts towards the checksum
+    view[0:5] = BULK_DUMP_HEADER
+    checksum = 0x7E ^ 0x00 ^ 0x08 ^ 0x01
+
+    sysex[5] = program_number
+    checksum ^= program_number
+
+    name = tuning_name(scala_name).encode('ascii')
+    view[6:22] = name
+    for char in name:
+        checksum ^= char
+
+    # 128 frequency data words, xx yy zz
+    pos = 22
+    if hasattr(scala_freq_data, 'tobytes'):
+        # a 128 x 3 uint8 row from tuning_tables()
+        data = scala_freq_data.tobytes()
+        view[pos:pos + len(data)] = data
+        for byte in data:
+            checksum ^= byte
+        pos += len(data)
+    else:
+        for xx, yy, zz in scala_freq_data:
+            sysex[pos] = xx
+            sysex[pos + 1] = yy
+            sysex[pos + 2] = zz
+            checksum ^= xx ^ yy ^ zz
+            pos += 3
+
+    # footer
+    sysex[pos] = checksum & 0x7F
+    sysex[pos + 1] = 0xF7
+
+    return bytes(sysex)
+
+
+# byte offsets of the program number and the checksum in a bulk tuning dump
+PROGRAM_OFFSET = 5
+CHECKSUM_OFFSET = BULK_DUMP_LENGTH - 2
+
+
+# copy a bulk tuning dump to another program number
+# only the program byte changes, so the checksum is patched by XOR'ing the old number out and the new one in
+def set_program_number(sysex, program_number):
+    return build_bank([sysex], [program_number])
+
+
+# concatenate bulk tuning dumps into one bank file, dump i goes to program_numbers[i]
+# the same dump can be passed several times to put one scale in many slots
+def build_bank(sysex_list, program_numbers):
+    sysex_list = list(sysex_list)
+    program_numbers = list(program_numbers)
+    if len(sysex_list) != len(program_numbers):
+        raise ValueError("Expected %d program numbers, got %d" % (len(sysex_list), len(program_numbers)))
+
+    bank = bytearray(BULK_DUMP_LENGTH * len(sysex_list))
+    view = memoryview(bank)
+    for i, (sysex, program_number) in enumerate(zip(sysex_list, program_numbers)):
+        if len(sysex) != BULK_DUMP_LENGTH or sysex[:5] != BULK_DUMP_HEADER:
+            raise ValueError("Not a bulk tuning dump")
+        if not 0 <= program_number <= 127:
+            raise ValueError("Program number must be between 0 and 127, not %s" % program_number)
+        offset = i * BULK_DUMP_LENGTH
+        view[offset:offset + BULK_DUMP_LENGTH] = sysex
+        bank[offset + CHECKSUM_OFFSET] ^= bank[offset + PROGRAM_OFFSET] ^ program_number
+        bank[offset + PROGRAM_OFFSET] = program_number
+
+    return bytes(bank)
+
+
+# --------------------------------------------------------
+
+"""
+Single note tuning change (real-time), for retuning notes while playing:
+
+        F0 7F dd 08 02 tt ll [kk xx yy zz] * ll F7
+
+where
+
+        7F    = universal real-time SysEx header
+        dd    = target device ID (7F = all devices)
+        08 02 = MIDI tuning standard, single note tuning change
+        tt    = tuning program number
+        ll    = number of changes in this message (1 to 127)
+        kk    = MIDI note number to change
+        xx yy zz = frequency data word for that note
+
+There is no checksum.
+"""
+
+ALL_DEVICES = 0x7F
+MAX_NOTE_CHANGES = 127
+
+
+# the notes whose frequency data differs between two tunings, as (note, (xx, yy, zz))
+def diff_freq_data(old_freq_data, new_freq_data):
+    changes = []
+    for note, (old_word, new_word) in enumerate(zip(old_freq_data, new_freq_data)):
+        old_word = tuple(int(byte) for byte in old_word)
+        new_word = tuple(int(byte) for byte in new_word)
+        if old_word != new_word:
+            changes.append((note, new_word))
+    return changes
+
+
+# pack (note, word) changes into as few single note tuning change messages as possible
+def build_note_changes(changes, program_number, device_id=ALL_DEVICES, max_per_message=MAX_NOTE_CHANGES):
+    if not 0 <= program_number <= 127:
+        raise ValueError("Program number must be between 0 and 127, not %s" % program_number)
+    if not 1 <= max_per_message <= MAX_NOTE_CHANGES:
+        raise ValueError("max_per_message must be between 1 and %d" % MAX_NOTE_CHANGES)
+
+    messages = bytearray()
+    for start in range(0, len(changes), max_per_message):
+        chunk = changes[start:start + max_per_message]
+        messages += bytes((0xF0, 0x7F, device_id, 0x08, 0x02, program_number, len(chunk)))
+        for note, (xx, yy, zz) in chunk:
+            messages += bytes((note, xx, yy, zz))
+        messages.append(0xF7)
+    return bytes(messages)
+
+
+"""
+Scale/octave tuning, the same offset for a note name in every octave:
+
+        F0 7E dd 08 08 ff gg hh [ss] * 12 F7            1 byte form
+        F0 7E dd 08 09 ff gg hh [ss tt] * 12 F7         2 byte form
+
+where
+
+        7E    = universal non-realtime SysEx header (7F for real-time)
+        ff gg hh = channel bitmap, ff = channels 15-16, gg = 8-14, hh = 1-7
+        ss    = 1 byte form: offset of C, C#, ... B from equal temperament,
+                in cents, 00 = -64, 40 = 0, 7F = +63
+        ss tt = 2 byte form: 14 bit offset, 00 00 = -100 cents,
+                40 00 = 0, 7F 7F = +100 cents (100/8192 cent units)
+"""
+
+SCALE_OCTAVE_LENGTHS = {1: 21, 2: 33}
+
+# how far an octave may be from 1200 cents and still count as repeating
+OCTAVE_TOLERANCE = 0.01
+
+
+# the cents of a frequency data word, relative to MIDI note 0
+def freq_data_to_cents(word):
+    xx, yy, zz = word
+    return xx * 100 + ((yy << 7) | zz) * 100 / 16384
+
+
+# the offsets of C, C# ... B from equal temperament (A = 440 Hz) in cents,
+# or None if the 128 frequencies don't repeat every 12 notes at 2/1
+# clamped lists notes known to be clamped, e.g. read back from a bulk dump
+def scale_octave_offsets(freqs, clamped=()):
+    offsets = [None] * 12
+    for note, freq in enumerate(freqs):
+        # notes clamped by the bulk dump range say nothing about the scale
+        if note in clamped or not MIN_FREQ < freq < MAX_FREQ:
+            continue
+        offset = 1200 * math.log2(freq / 440) - (note - 69) * 100
+        if offsets[note % 12] is None:
+            offsets[note % 12] = offset
+        elif abs(offsets[note % 12] - offset) > OCTAVE_TOLERANCE:
+            return None
+    if None in offsets:
+        return None
+    return offsets
+
+
+# quantize offsets to the 1 or 2 byte form, returns the data bytes and the offsets they encode
+def quantize_scale_octave(offsets, form):
+    data = []
+    encoded = []
+    for offset in offsets:
+        if form == 1:
+            value = round(offset) + 64
+            if not 0 <= value <= 127:
+                return None
+            data.append(value)
+            encoded.append(value - 64)
+        else:
+            value = round(offset * 8192 / 100) + 8192
+            if not 0 <= value <= 16383:
+                return None
+            data += [value >> 7, value & 0x7F]
+            encoded.append((value - 8192) * 100 / 8192)
+    return data, encoded
+
+
+def build_scale_octave(data, form, channels=range(16), realtime=False, device_id=ALL_DEVICES):
+    if form not in SCALE_OCTAVE_LENGTHS:
+        raise ValueError("Scale/octave tuning form must be 1 or 2, not %s" % form)
+    mask = 0
+    for channel in channels:
+        mask |= 1 << channel
+    sysex = bytearray((0xF0, 0x7F if realtime else 0x7E, device_id, 0x08, 0x07 + form))
+    sysex += bytes(((mask >> 14) & 0x03, (mask >> 7) & 0x7F, mask & 0x7F))
+    sysex += bytes(data)
+    sysex.append(0xF7)
+    return bytes(sysex)
+
+
+# the scale/octave tuning message for a tuning, if it can be expressed as one,
+# returns (sysex, largest difference in cents from the bulk dump) or None
+def scale_octave_tuning(tuning, form=2, channels=range(16), realtime=False):
+    offsets = scale_octave_offsets(tuning.freqs)
+    if offsets is None:
+        return None
+    quantized = quantize_scale_octave(offsets, form)
+    if quantized is None:
+        return None
+    data, encoded = quantized
+
+    # compare with what the bulk dump would tune each note to
+    max_error = 0.0
+    for note, (freq, word) in enumerate(zip(tuning.freqs, tuning.freq_data)):
+        if MIN_FREQ < freq < MAX_FREQ:
+            error = abs(note * 100 + encoded[note % 12] - freq_data_to_cents(word))
+            max_error = max(max_error, error)
+
+    return build_scale_octave(data, form, channels, realtime), max_error
+
+
+# --------------------------------------------------------
+# reading bulk tuning dumps back
+
+BulkDump = namedtuple('BulkDump', ['offset', 'device_id', 'program_number', 'name', 'freq_data', 'checksum', 'checksum_ok'])
+
+NO_CHANGE = (0x7F, 0x7F, 0x7F)
+
+# the words frequencies outside MIN_FREQ..MAX_FREQ are clamped to, they decode
+# to slightly different Hz than the rounded constants so they are compared as words
+CLAMPED_WORDS = {
+    (0, 0, 0),
+    (MAX_FREQ_DATA_POSITION >> 14, (MAX_FREQ_DATA_POSITION >> 7) & 0x7F, MAX_FREQ_DATA_POSITION & 0x7F),
+}
+
+
+# the frequency of a frequency data word, None for 7F 7F 7F (no change)
+def freq_data_to_hz(word):
+    if tuple(word) == NO_CHANGE:
+        return None
+    return 440 * 2**((freq_data_to_cents(word) - 6900) / 1200)
+
+
+# XOR of all bytes, by folding them as one big integer instead of looping over them
+def xor_bytes(data):
+    size = 1
+    while size < len(data):
+        size *= 2
+    value = int.from_bytes(data, 'little')
+    bits = size * 8
+    while bits > 8:
+        bits //= 2
+        value = (value >> bits) ^ (value & ((1 << bits) - 1))
+    return value
+
+
+# yield every bulk tuning dump in a buffer (bytes, bytearray, mmap or memoryview),
+# skipping anything else, like other SysEx messages between them
+def iter_bulk_dumps(buffer):
+    # mmap and bytes can search without copying, a memoryview is copied once
+    if not hasattr(buffer, 'find'):
+        buffer = memoryview(buffer).tobytes()
+    view = memoryview(buffer)
+    end = len(buffer) - BULK_DUMP_LENGTH
+
+    offset = buffer.find(b'\xf0\x7e', 0)
+    while 0 <= offset <= end:
+        if view[offset + 3] == 0x08 and view[offset + 4] == 0x01 and view[offset + BULK_DUMP_LENGTH - 1] == 0xF7:
+            message = view[offset:offset + BULK_DUMP_LENGTH]
+            data = message[22:CHECKSUM_OFFSET].tobytes()
+            yield BulkDump(
+                offset,
+                message[2],
+                message[PROGRAM_OFFSET],
+                message[6:22].tobytes().decode('ascii', 'replace').rstrip(),
+                list(zip(data[0::3], data[1::3], data[2::3])),
+                message[CHECKSUM_OFFSET],
+                xor_bytes(message[1:CHECKSUM_OFFSET]) & 0x7F == message[CHECKSUM_OFFSET],
+            )
+            offset += BULK_DUMP_LENGTH
+        else:
+            offset += 1
+        offset = buffer.find(b'\xf0\x7e', offset)
+
+
+# memory-map a .syx file and return its bulk tuning dumps
+def read_syx_file(path):
+    import mmap
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return list(iter_bulk_dumps(buffer))
+
+
+# an equivalent Scala file for a bulk dump, returns (text, base_note, base_freq)
+# 12 note tunings that repeat at 2/1 become a 12 note scale on base_note,
+# anything else a 127 note scale on MIDI note 0 that reproduces every note
+def bulk_dump_to_scala(dump, base_note=60, file_name=None):
+    freqs = [freq_data_to_hz(word) for word in dump.freq_data]
+    # notes that are left unchanged keep their equal tempered frequency
+    freqs = [440 * 2**((note - 69) / 12) if freq is None else freq for note, freq in enumerate(freqs)]
+
+    clamped = {note for note, word in enumerate(dump.freq_data) if tuple(word) in CLAMPED_WORDS}
+
+    offsets = scale_octave_offsets(freqs, clamped)
+    if offsets is not None and base_note + 12 <= 127:
+        # taken from the offsets, the notes of the octave on base_note may themselves be clamped
+        base_offset = offsets[base_note % 12]
+        pitches = ["%.5f" % (step * 100 + offsets[(base_note + step) % 12] - base_offset) for step in range(1, 12)] + ["2/1"]
+        base_freq = 440 * 2**(((base_note - 69) * 100 + base_offset) / 1200)
+    else:
+        base_note = 0
+        pitches = ["%.5f" % (1200 * math.log2(freq / freqs[0])) for freq in freqs[1:]]
+        base_freq = freqs[base_note]
+
+    name = file_name or (dump.name or "tuning") + ".scl"
+    lines = [
+        "! " + name,
+        "!",
+        "%s (program %d)" % (dump.name, dump.program_number),
+        " %d" % len(pitches),
+        "!",
+        "! base note %d, base frequency %.6f Hz" % (base_note, base_freq),
+        "!",
+    ] + [" " + pitch for pitch in pitches]
+    return "\n".join(lines) + "\n", base_note, base_freq
+
+
+# --------------------------------------------------------
+
+class StageTimer:
+    """
+    Time spent in each stage of a conversion, for --profile and the
+    Server-Timing header of the web app.
+
+        timer = StageTimer()
+        sysex = scl_to_syx(read_scala_file(path, timer), timer=timer)
+        print(timer.report())
+
+    The pipeline functions take an optional timer and only check it for
+    None when it isn't given, so they can stay instrumented in production.
+    A stage that runs more than once adds up.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.last = time.perf_counter()
+
+    def restart(self):
+        self.last = time.perf_counter()
+
+    # the time since the last lap or restart goes to stage
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    # add the timings of another timer, e.g. from a worker process
+    def merge(self, timings):
+        for stage, seconds in timings.items():
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def total(self):
+        return sum(self.timings.values())
+
+    def report(self):
+        total = self.total()
+        lines = []
+        for stage, seconds in self.timings.items():
+            lines.append("%-12s %10.3f ms %5.1f%%" % (stage, seconds * 1000, 100 * seconds / total if total else 0))
+        lines.append("%-12s %10.3f ms" % ("total", total * 1000))
+        return "\n".join(lines)
+
+    # the value of a Server-Timing header, durations in ms
+    def server_timing(self):
+        return ", ".join("%s;dur=%.3f" % (stage, seconds * 1000) for stage, seconds in list(self.timings.items()) + [("total", self.total())])
+
+
+# run the pipeline up to the frequency data words
+def scala_tuning(text, base_note=69, base_freq=440, timer=None):
+    if timer is not None:
+        timer.restart()
+    scale = parse_scala(text)
+    if timer is not None:
+        timer.lap('parse')
+    scala_cents = scale_to_cents(scale.notes)
+    scala_ratios = cents_to_ratios(scala_cents, scale.notes)
+    if timer is not None:
+        timer.lap('cents')
+    scala_freqs = tuning_frequencies(scala_ratios, scale.notes_per_octave, base_note, base_freq, scala_cents)
+    if timer is not None:
+        timer.lap('frequencies')
+    scala_freq_data = [hz_to_freq_data(freq) for freq in scala_freqs]
+    if timer is not None:
+        timer.lap('encode')
+    return Tuning(scale, scala_cents, scala_ratios, scala_freqs, scala_freq_data)
+
+
+# run the whole pipeline on the text of a Scala file
+def scl_to_syx(text, program_number=1, base_note=69, base_freq=440, timer=None):
+    tuning = scala_tuning(text, base_note, base_freq, timer)
+    sysex = build_sysex(tuning.scale.name, tuning.freq_data, program_number)
+    if timer is not None:
+        timer.lap('sysex')
+    return sysex
+
+
+# single note tuning changes that retune from the scale in old_text to the one in text
+def scl_to_note_changes(old_text, text, program_number=1, base_note=69, base_freq=440):
+    old_tuning = scala_tuning(old_text, base_note, base_freq)
+    tuning = scala_tuning(text, base_note, base_freq)
+    return build_note_changes(diff_freq_data(old_tuning.freq_data, tuning.freq_data), program_number)
+
+
+# --------------------------------------------------------
+
+class TuningSession:
+    """
+    One Scala file with its conversion parameters, keeping the result of
+    every pipeline stage until something it depends on changes.
+
+        session = TuningSession.from_file("grady-sisiutl.scl")
+        session.sysex                # runs the whole pipeline
+        session.base_freq = 298      # keeps the parsed scale, cents and ratios
+        session.program_number = 7   # patches one byte and the checksum
+
+    computed counts how often each stage actually ran. Setting timer to a
+    StageTimer also times them.
+    """
+
+    # the stages in pipeline order, dropping one drops everything after it
+    STAGES = ('text', 'scale', 'cents', 'ratios', 'freqs', 'freq_data', 'sysex')
+    # the same stages as scl_to_syx reports to a StageTimer
+    TIMER_STAGES = {'text': 'decode', 'scale': 'parse', 'cents': 'cents', 'ratios': 'cents', 'freqs': 'frequencies', 'freq_data': 'encode', 'sysex': 'sysex'}
+
+    def __init__(self, text=None, data=None, program_number=1, base_note=69, base_freq=440):
+        if (text is None) == (data is None):
+            raise ValueError("Pass either text or data")
+        self._data = data
+        self._program_number = program_number
+        self._base_note = base_note
+        self._base_freq = base_freq
+        self._stages = {}
+        self.decoder = None
+        self.computed = Counter()
+        self.timer = None
+        if text is not None:
+            self._stages['text'] = text
+
+    @classmethod
+    def from_file(cls, path, **params):
+        with open(path, 'rb') as f:
+            return cls(data=f.read(), **params)
+
+    def invalidate(self, stage):
+        for name in self.STAGES[self.STAGES.index(stage):]:
+            self._stages.pop(name, None)
+
+    def _stage(self, name, compute):
+        if name not in self._stages:
+            if self.timer is None:
+                self._stages[name] = compute()
+            else:
+                # a stage computes the ones it needs first, which lap on their own
+                self.timer.restart()
+                self._stages[name] = compute()
+                self.timer.lap(self.TIMER_STAGES[name])
+            self.computed[name] += 1
+        return self._stages[name]
+
+    # --------------------------------------------------------
+    # inputs and parameters
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        if data != self._data:
+            self._data = data
+            self.invalidate('text')
+
+    @property
+    def text(self):
+        return self._stage('text', self._decode)
+
+    @text.setter
+    def text(self, text):
+        if self._stages.get('text') != text:
+            self._data = None
+            self.invalidate('text')
+            self._stages['text'] = text
+
+    @property
+    def base_note(self):
+        return self._base_note
+
+    @base_note.setter
+    def base_note(self, base_note):
+        if base_note != self._base_note:
+            self._base_note = base_note
+            self.invalidate('freqs')
+
+    @property
+    def base_freq(self):
+        return self._base_freq
+
+    @base_freq.setter
+    def base_freq(self, base_freq):
+        if base_freq != self._base_freq:
+            self._base_freq = base_freq
+            self.invalidate('freqs')
+
+    @property
+    def program_number(self):
+        return self._program_number
+
+    @program_number.setter
+    def program_number(self, program_number):
+        if program_number != self._program_number:
+            if not 0 <= program_number <= 127:
+                raise ValueError("Program number must be between 0 and 127, not %s" % program_number)
+            self._program_number = program_number
+            # only the program byte and the checksum depend on it
+            if 'sysex' in self._stages:
+                self._stages['sysex'] = set_program_number(self._stages['sysex'], program_number)
+
+    # --------------------------------------------------------
+    # stages
+
+    def _decode(self):
+        text, self.decoder = decode_scala_with_decoder(self._data)
+        return text
+
+    @property
+    def scale(self):
+        return self._stage('scale', lambda: parse_scala(self.text))
+
+    @property
+    def cents(self):
+        return self._stage('cents', lambda: scale_to_cents(self.scale.notes))
+
+    @property
+    def ratios(self):
+        return self._stage('ratios', lambda: cents_to_ratios(self.cents, self.scale.notes))
+
+    @property
+    def freqs(self):
+        return self._stage('freqs', lambda: tuning_frequencies(self.ratios, self.scale.notes_per_octave, self._base_note, self._base_freq, self.cents))
+
+    @property
+    def freq_data(self):
+        return self._stage('freq_data', lambda: [hz_to_freq_data(freq) for freq in self.freqs])
+
+    @property
+    def sysex(self):
+        return self._stage('sysex', lambda: build_sysex(self.scale.name, self.freq_data, self._program_number))
+
+    @property
+    def tuning(self):
+        return Tuning(self.scale, self.cents, self.ratios, self.freqs, self.freq_data)
@@ -0,0 +1,295 @@
+# Path: mtsstore.py
+# Author: Olle Holmberg, 2022-2023
+# License: GPL v3
+#
+# https://github.com/unremarkablegarden/scala2mts
+
+
+"""
+Precompiled store of a whole Scala archive, for serving conversions of
+archive scales without decoding or parsing anything.
+
+A store is built once (scala2mts.py --build-store) and memory-mapped
+read-only, so every worker process shares the same pages.
+
+Layout, all little endian:
+
+        header      64 bytes, see HEADER
+        records     count * record_size bytes
+        name index  count * u32, record numbers sorted by name
+        hash index  count * (16 byte digest + u32), sorted by digest
+
+Every record has the same size, so the cents of all scales can also be
+read as one strided array (see SimilarityIndex):
+
+        name        64 bytes, the file name without .scl, UTF-8, NUL padded
+        tuning name 16 bytes, as it appears in the bulk dump
+        notes       u16, notes per octave
+        (padding)   6 bytes
+        payload     384 bytes, the 128 frequency data words for the
+                    store's default base note and base frequency
+        cents       max_notes * f64, the cents of every note, NaN padded
+"""
+
+import os
+import re
+import mmap
+import struct
+import hashlib
+import heapq
+from collections import namedtuple
+
+import mtsengine
+
+
+MAGIC = b'SCL2MTS\x01'
+
+# magic, record count, record size, max notes, default base note, default base freq,
+# name index offset, hash index offset
+HEADER = struct.Struct('<8sIIIId QQ 12x')
+RECORD = struct.Struct('<64s16sH6x384s')
+HASH_ENTRY = struct.Struct('<16sI')
+NAME_INDEX_ENTRY = struct.Struct('<I')
+
+PAYLOAD_OFFSET = 64 + 16 + 2 + 6
+PAYLOAD_LENGTH = 384
+
+StoredScale = namedtuple('StoredScale', ['name', 'tuning_name', 'notes_per_octave', 'cents', 'payload'])
+Match = namedtuple('Match', ['name', 'distance', 'mode', 'record'])
+
+
+# the key of a Scala file in the hash index
+def content_digest(data):
+    return hashlib.sha256(data).digest()[:16]
+
+
+# --------------------------------------------------------
+
+# convert every (name, data) Scala file once and write the store to path,
+# returns (number of scales stored, list of (name, error) for the ones that failed)
+def build_store(sources, path, base_note=69, base_freq=440):
+    scales = []
+    failed = []
+    names = set()
+    for name, data in sources:
+        name = os.path.splitext(os.path.basename(name))[0]
+        if name in names:
+            failed.append((name, "duplicate name"))
+            continue
+        try:
+            session = mtsengine.TuningSession(data=data, base_note=base_note, base_freq=base_freq)
+            payload = bytes(byte for word in session.freq_data for byte in word)
+            scales.append((name, mtsengine.tuning_name(session.scale.name), session.scale.notes_per_octave, session.cents, payload, content_digest(data)))
+            names.add(name)
+        except Exception as e:
+            failed.append((name, "%s: %s" % (type(e).__name__, e)))
+
+    max_notes = max([len(scale[3]) for scale in scales] + [1])
+    record_size = RECORD.size + 8 * max_notes
+    cents_format = struct.Struct('<%dd' % max_notes)
+    name_index_offset = HEADER.size + record_size * len(scales)
+    hash_index_offset = name_index_offset + NAME_INDEX_ENTRY.size * len(scales)
+
+    # written next to the target and renamed, so a running app never maps a half written store
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(scales), record_size, max_notes, base_note, base_freq, name_index_offset, hash_index_offset))
+        for name, scale_tuning_name, notes_per_octave, cents, payload, digest in scales:
+            f.write(RECORD.pack(name.encode('utf-8')[:64], scale_tuning_name.encode('ascii'), notes_per_octave, payload))
+            f.write(cents_format.pack(*(list(cents) + [float('nan')] * (max_notes - len(cents)))))
+        for i in sorted(range(len(scales)), key=lambda i: scales[i][0].encode('utf-8')[:64]):
+            f.write(NAME_INDEX_ENTRY.pack(i))
+        for digest, i in sorted((scale[5], i) for i, scale in enumerate(scales)):
+            f.write(HASH_ENTRY.pack(digest, i))
+    os.replace(temporary_path, path)
+
+    return len(scales), failed
+
+
+# --------------------------------------------------------
+
+class ScaleStore:
+    """
+    A memory-mapped store built by build_store(). Lookups are binary
+    searches directly on the mapped pages, nothing is loaded up front.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.buffer)
+
+        magic, self.count, self.record_size, self.max_notes, self.base_note, self.base_freq, self.name_index_offset, self.hash_index_offset = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(path + " is not a scale store")
+        self.cents_format = struct.Struct('<%dd' % self.max_notes)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.view.release()
+        self.buffer.close()
+
+    def _record_offset(self, i):
+        return HEADER.size + i * self.record_size
+
+    def name(self, i):
+        return RECORD.unpack_from(self.buffer, self._record_offset(i))[0].rstrip(b'\x00').decode('utf-8')
+
+    def record(self, i):
+        offset = self._record_offset(i)
+        name, scale_tuning_name, notes_per_octave, payload = RECORD.unpack_from(self.buffer, offset)
+        cents = self.cents_format.unpack_from(self.buffer, offset + RECORD.size)
+        return StoredScale(
+            name.rstrip(b'\x00').decode('utf-8'),
+            scale_tuning_name.decode('ascii'),
+            notes_per_octave,
+            [value for value in cents if value == value],
+            self.view[offset + PAYLOAD_OFFSET:offset + PAYLOAD_OFFSET + PAYLOAD_LENGTH],
+        )
+
+    # record number of a scale by its file name (without .scl), or None
+    def find_name(self, name):
+        key = name.encode('utf-8')[:64]
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            i = NAME_INDEX_ENTRY.unpack_from(self.buffer, self.name_index_offset + middle * NAME_INDEX_ENTRY.size)[0]
+            found = RECORD.unpack_from(self.buffer, self._record_offset(i))[0].rstrip(b'\x00')
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return i
+        return None
+
+    # record number of a scale by the bytes of its Scala file, or None
+    def find_content(self, data):
+        key = content_digest(data)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            digest, i = HASH_ENTRY.unpack_from(self.buffer, self.hash_index_offset + middle * HASH_ENTRY.size)
+            if digest < key:
+                low = middle + 1
+            elif digest > key:
+                high = middle
+            else:
+                return i
+        return None
+
+    # the bulk tuning dump of a stored scale,
+    # straight from the stored payload for the default base note and frequency
+    def sysex(self, i, program_number=1, base_note=None, base_freq=None):
+        scale = self.record(i)
+        if base_note is None:
+            base_note = self.base_note
+        if base_freq is None:
+            base_freq = self.base_freq
+        if base_note == self.base_note and base_freq == self.base_freq:
+            return mtsengine.build_sysex(scale.tuning_name, scale.payload, program_number)
+
+        scala_ratios = mtsengine.cents_to_ratios(scale.cents)
+        scala_freqs = mtsengine.tuning_frequencies(scala_ratios, scale.notes_per_octave, base_note, base_freq, scale.cents)
+        scala_freq_data = [mtsengine.hz_to_freq_data(freq) for freq in scala_freqs]
+        return mtsengine.build_sysex(scale.tuning_name, scala_freq_data, program_number)
+
+
+# --------------------------------------------------------
+
+# parse a list of pitches separated by commas or whitespace, like "204.0, 386.3, 3/2, 1200"
+# unlike in a Scala file, a bare number is cents, n/m is still a ratio
+def parse_cents_list(text):
+    scala_cents = []
+    for value in re.split(r"[,\s]+", text.strip()):
+        if not value:
+            continue
+        if "/" in value:
+            scala_cents.append(mtsengine.note_to_cents(mtsengine.parse_pitch(value, 1, text)))
+            continue
+        try:
+            scala_cents.append(float(value))
+        except ValueError:
+            raise mtsengine.ScalaError(1, text, "%s is not a valid cents value" % value)
+    if not scala_cents:
+        raise mtsengine.ScalaError(1, text, "no pitches given")
+    return scala_cents
+
+
+# the cents of every mode of a scale, mode r starts on its r-th note (mode 0 is the scale itself)
+# the last note of each mode is the period
+def scale_modes(scala_cents):
+    count = len(scala_cents)
+    period = scala_cents[-1]
+    positions = [0.0] + list(scala_cents[:-1])
+    positions += [position + period for position in positions]
+    return [[positions[r + j] - positions[r] for j in range(1, count + 1)] for r in range(count)]
+
+
+class SimilarityIndex:
+    """
+    Finds the scales in a store closest to a given one. The distance is the
+    RMS difference in cents between their notes, taking the mode of the
+    stored scale that fits best, so a scale matches its own rotations.
+    Only scales with the same number of notes are compared.
+
+    Every mode of every stored scale is computed once, grouped by number of
+    notes, and a query is a few array operations over its group.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.groups = {}
+
+        np = mtsengine.load_numpy()
+        if np is None:
+            for i in range(len(store)):
+                modes = scale_modes(store.record(i).cents)
+                records, group_modes = self.groups.setdefault(len(modes), ([], []))
+                records.append(i)
+                group_modes.append(modes)
+            return
+
+        # the cents of every record, straight from the mapped store
+        all_cents = np.ndarray((store.count, store.max_notes), dtype='<f8', buffer=store.buffer, offset=HEADER.size + RECORD.size, strides=(store.record_size, 8))
+        counts = np.count_nonzero(~np.isnan(all_cents), axis=1)
+        for count in np.unique(counts):
+            count = int(count)
+            records = np.flatnonzero(counts == count)
+            scala_cents = all_cents[records, :count]
+            positions = np.concatenate([np.zeros((len(records), 1)), scala_cents[:, :-1]], axis=1)
+            positions = np.concatenate([positions, positions + scala_cents[:, -1:]], axis=1)
+            steps = np.arange(count)
+            # modes[scale, r, j] = positions[r + j + 1] - positions[r]
+            modes = positions[:, steps[:, None] + steps[None, :] + 1] - positions[:, :count, None]
+            self.groups[count] = (records, modes)
+
+    # the k nearest stored scales to the given cents, nearest first
+    def nearest(self, scala_cents, k=10):
+        group = self.groups.get(len(scala_cents))
+        if group is None or k <= 0:
+            return []
+        records, modes = group
+
+        np = mtsengine.load_numpy()
+        if np is None:
+            distances = []
+            for i, scale in zip(records, modes):
+                mode_distances = [sum((a - b) ** 2 for a, b in zip(mode, scala_cents)) for mode in scale]
+                best = min(range(len(scale)), key=mode_distances.__getitem__)
+                distances.append(((mode_distances[best] / len(scala_cents)) ** 0.5, i, best))
+            return [Match(self.store.name(i), distance, mode, i) for distance, i, mode in heapq.nsmallest(k, distances)]
+
+        query = np.asarray(scala_cents, dtype=float)
+        mode_distances = np.sqrt(np.mean((modes - query) ** 2, axis=2))
+        best_modes = np.argmin(mode_distances, axis=1)
+        distances = mode_distances[np.arange(len(records)), best_modes]
+        if k < len(distances):
+            nearest = np.argpartition(distances, k)[:k]
+        else:
+            nearest = np.arange(len(distances))
+        nearest = nearest[np.lexsort((nearest, distances[nearest]))]
+        return [Match(self.store.name(int(records[n])), float(distances[n]), int(best_modes[n]), int(records[n])) for n in nearest]
@@ -21,376 +21,714 @@ Arguments:
 -n base_note: the base note as a number (default = 69 = A4)
 -f base_freq: the base frequency of the Scala file (default = 440.000)
 -p program_number: which memory slot to store the tuning in the synth
+--slots list: write the tuning to several memory slots in one file, e.g. 0-7,10 (instead of -p)
+--from file: the Scala file currently loaded, only write real-time single note
+    tuning changes for the notes that differ from it (instead of a bulk dump)
+--scale-octave 1|2: write a scale/octave tuning message in the 1 or 2 byte form
+    (instead of a bulk dump), for 12 note scales that repeat at 2/1
+--profile: print how long each stage of the conversion took
+--verify: check the frequency data encoder against a high precision reference
+    over the whole MIDI range and print the largest error in cents
 -h help: show this help message
+
+Batch mode:
+python scala2mts.py [options] <directory or glob pattern> ...
+
+Converts every .scl file found, in parallel and without prompting.
+Directories are searched recursively. -n, -f and -p apply to every file.
+Options can come before or after the paths.
+-o output directory: where to write the .syx files (default: next to each input file)
+-j jobs: number of worker processes (default: the number of available cores)
+--overwrite policy: what to do with existing .syx files (default: never)
+    never  = skip the file
+    always = replace it
+    newer  = replace it if the Scala file (or archive member) is newer
+
+.zip and .tar (.tar.gz, .tgz, .tar.bz2, .tar.xz) archives can be given as
+inputs, and their .scl members are read straight from the archive. If -o
+names a .zip or .tar archive, all results are written into it; an
+existing output archive is only replaced with --overwrite always. Archives
+are processed one member at a time, without extracting anything to disk.
+
+--bank file: instead of one .syx per scale, pack all scales into one
+    bank file, in consecutive memory slots starting at -p
+--build-store file: instead of .syx files, convert every scale once into a
+    precompiled scale store for the web app (see mtsstore.py), -n and -f
+    set the base note and frequency of its stored bulk dumps
+
+Similar scales:
+python scala2mts.py --similar <scale store> (-i file | --cents list) [-k count]
+
+Lists the scales in a store built with --build-store that are closest to the
+Scala file or the list of cents (e.g. "204, 386.3, 702, 1200", n/m are ratios),
+in any mode. The distance is the RMS difference in cents between their notes.
+-k count: how many scales to list (default: 10)
+
+Decoding:
+python scala2mts.py --decode [-o directory] [-n base_note] <.syx files, directories or globs> ...
+
+Lists every bulk tuning dump in the .syx files and checks its checksum.
+With -o, an equivalent .scl file is written for every dump (12 note
+tunings that repeat at 2/1 are written as a 12 note scale on -n, default 60).
 """
 
 import sys
 import os
+import io
+import time
+import glob
 import getopt
-import math
-import functools
-import operator
+import tarfile
+import zipfile
 import textwrap
-import chardet
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
+import mtsengine
+import mtsstore
 
-# define defaults
-input_file = None
-output_file = None
-program_number = 1
 
-base_note = 69
-base_freq = 440
-# base_note = 48
-# base_freq = 261.625565
+def write_file(sysex, output_file, timer=None):
+    if timer is not None:
+        timer.restart()
+    # open output_file in binary write mode
+    with open(output_file, "wb") as f:
+        # write sysex to output_file
+        f.write(sysex)
+    if timer is not None:
+        timer.lap('write')
+    print("Wrote sysex to " + output_file)
 
-# parse command line arguments
-try:
-    opts, args = getopt.getopt(sys.argv[1:], "hi:o:n:f:p:", ["help", "input=", "output=", "base_note=", "base_freq=", "program_number="])
-except getopt.GetoptError as err:
-    print(err)
-    sys.exit(2)
 
-for o, a in opts:
-    if o in ("-h", "--help"):
-        print(__doc__)
-        sys.exit()
-    elif o in ("-i", "--input"):
-        input_file = a
-    elif o in ("-o", "--output"):
-        output_file = a
-    elif o in ("-n", "--base_note"):
-        base_note = int(a)
-    elif o in ("-f", "--base_freq"):
-        base_freq = float(a)
-    elif o in ("-p", "--program_number"):
-        # first is actually 0
-        program_number = int(a)
-    else:
-        assert False, "unhandled option"
-    
-# check if any flags are specified
-if len(opts) == 0:
-    print(__doc__)
-    sys.exit()
-        
-# check for required arguments
-if input_file is None:
-    print("Error: input file is required")
-    sys.exit(2)
-    
-# set output file name if not specified
-if output_file is None:
-    # remove file extension
-    output_file = os.path.splitext(input_file)[0]
-    # add .syx extension
-    output_file = output_file + ".syx"
-    
-
-# Open the file in binary mode to avoid decoding errors
-with open(input_file, 'rb') as f:
-    # Detect the file encoding
-    result = chardet.detect(f.read())
-    file_encoding = result['encoding']
-
-# Reopen the file with the detected encoding and convert it to UTF-8
-with open(input_file, 'r', encoding=file_encoding) as f:
-    scala_lines = f.readlines()
-
-# parse the Scala file
-scala_name = scala_lines[0].strip()
-
-# remove the ! and space from the name
-scala_name = scala_name[2:]
-
-# remove full path, if it exists
-if "/" in scala_name:
-    scala_name = scala_name.split('/')[-1]
-
-# remove the .scl extension
-scala_name = scala_name.replace(".scl", "")
-
-# replace dashes and underlines with spaces
-# scala_name = scala_name.replace("-", " ")
-# scala_name = scala_name.replace("_", " ")
-
-
-# scala_description = the first scala_lines line that doesn't start with !
-scala_description = ""
-for line in scala_lines:
-    if not line.startswith("!"):
-        scala_description = line.strip()
-        break
-
-
-# get the number of notes
-# notes_per_octave = the first scala_lines line that starts with a number
-notes_per_octave = 0
-for line in scala_lines:
-    if line.startswith(" "):
-        notes_per_octave = int(line.strip())
-        break
-
-
-# notes raw data
-scala_notes = []
-for line in scala_lines:
-    if line.startswith(" "):
-        note = line.strip()
-        scala_notes.append(note)
-        
-# remove the first element, the number of notes
-scala_notes.pop(0)
-
-    
-# function to convert a frequency to a ratio
-def ratio_to_float(strrat):
-        nden = strrat.replace("/", ":").split(":")
-        if nden[0] == "x":
-                return None
-        elif len(nden) == 1:
-                res = float(nden[0])
-                return res
-        elif len(nden) == 2:
-                num, denom = nden
-                res = float(num)/float(denom)
-                return res
+# --------------------------------------------------------
+# batch mode
 
-        else:
-                raise Exception("%s is not a valid number or ratio" % strrat)
+OVERWRITE_POLICIES = ("never", "always", "newer")
 
 
-# function to convert a ratio to a frequency
-def ratio_to_cents(ratio):
-        if ratio is not None:
-                res = 1200 * math.log(ratio, 2)
+# yield (scala file, path relative to the output directory) for every directory, glob pattern or file given
+def find_scala_files(paths, extensions=(".scl",)):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(extensions):
+                        input_file = os.path.join(root, name)
+                        yield input_file, os.path.relpath(input_file, path)
+        elif os.path.isfile(path):
+            yield path, os.path.basename(path)
         else:
-                res = None
-        return res
-
-    
-# check if notes are frequencies or ratios
-scala_notes_are_ratios = False
-if "/" in scala_notes[0]:
-    scala_notes_are_ratios = True
-    
-scala_cents = []
-for i in range(len(scala_notes)):
-    if "/" in scala_notes[i]:
-        ratio = ratio_to_float(scala_notes[i])
-        cents = ratio_to_cents(ratio)
-        scala_cents.append(cents) 
-    else: 
-        scala_cents.append(scala_notes[i])
-
-
-# function to calculate ratio of cents
-def cents_to_ratio(cents):
-    ratio = 2**(cents/1200)
-    return ratio
-
-# calculate ratios of scale
-scala_ratios = []
-for note in scala_cents:
-    ratio = cents_to_ratio(float(note))
-    scala_ratios.append(ratio)
-
-# add the base frequency to the start of the list
-scala_ratios.insert(0, 1)
-
-# function to calculate frequency of note, based on base note and base frequency, using scala_ratios between notes, and the notes per octave
-def note_to_hz(note, base_note, base_freq, scala_ratios, notes_per_octave):
-    # calculate the note number within the octave
-    note_in_octave = (note - base_note) % notes_per_octave
-    # calculate the ratio of the note
-    ratio = scala_ratios[note_in_octave]
-    # calculate the octave of the note
-    octave = (note - base_note) // notes_per_octave
-    octave_size = scala_ratios[notes_per_octave]
-    # calculate the frequency of the note
-    freq = base_freq * (octave_size**octave) * ratio
-    return freq
-    
-    
-# calculate frequencies of notes
-scala_freqs = []
-for i in range(0, 128):
-    freq = note_to_hz(i, base_note, base_freq, scala_ratios, notes_per_octave)
-    scala_freqs.append(freq)
-
-# function to convert number to hex
-def num_to_hex(num):
-    hex = format(num, '02x')
-    return hex
-
-    
-"""
-Frequency data format (all bytes in hex)
-
-xx = semitone (MIDI note number to retune to, unit is 100 cents)
-yy = MSB of fractional part (1/128 semitone = 100/128 cents = .78125 cent units)
-zz = LSB of fractional part (1/16384 semitone = 100/16384 cents = .0061 cent units)
+            for input_file in sorted(glob.glob(path, recursive=True)):
+                if os.path.isfile(input_file) and input_file.lower().endswith(extensions):
+                    yield input_file, os.path.basename(input_file)
+
+
+# whether output_file may be written under the overwrite policy
+def should_write(input_file, output_file, overwrite):
+    return should_write_mtime(os.path.getmtime(input_file), output_file, overwrite)
+
+
+# same as should_write for an input that is only known by its modification time, e.g. an archive member
+def should_write_mtime(input_mtime, output_file, overwrite):
+    if not os.path.exists(output_file) or overwrite == "always":
+        return True
+    if overwrite == "newer":
+        return input_mtime > os.path.getmtime(output_file)
+    return False
+
+
+# convert one file in a worker process, errors are returned instead of raised so the batch keeps going
+def convert_job(job):
+    input_file, output_file, base_note, base_freq, program_number, overwrite, profile = job
+    # timers can't cross processes, their timings can
+    timer = mtsengine.StageTimer() if profile else None
+    try:
+        if not should_write(input_file, output_file, overwrite):
+            return input_file, output_file, "skipped", "already exists", None, None
+        with open(input_file, "rb") as f:
+            text, decoder = mtsengine.decode_scala_with_decoder(f.read())
+        if timer is not None:
+            timer.lap('decode')
+        sysex = mtsengine.scl_to_syx(text, program_number, base_note, base_freq, timer)
+        output_directory = os.path.dirname(output_file)
+        if output_directory:
+            os.makedirs(output_directory, exist_ok=True)
+        with open(output_file, "wb") as f:
+            f.write(sysex)
+        if timer is not None:
+            timer.lap('write')
+        return input_file, output_file, "written", "", decoder, timer.timings if timer is not None else None
+    except Exception as e:
+        return input_file, output_file, "failed", "%s: %s" % (type(e).__name__, e), None, None
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def convert_batch(paths, output_directory, base_note, base_freq, program_number, overwrite="never", jobs=None, timer=None):
+    # archives are read and written one member at a time in this process
+    if is_archive(output_directory or "") or any(is_archive(path) for path in paths):
+        return convert_stream(paths, output_directory, base_note, base_freq, program_number, overwrite, timer)
+
+    batch = []
+    for input_file, relative_path in find_scala_files(paths):
+        if output_directory is None:
+            output_file = os.path.splitext(input_file)[0] + ".syx"
+        else:
+            output_file = os.path.join(output_directory, os.path.splitext(relative_path)[0] + ".syx")
+        batch.append((input_file, output_file, base_note, base_freq, program_number, overwrite, timer is not None))
 
-Frequency data shall be sent via system exclusive messages. Because system exclusive data bytes have their high bit set low, containing 7 bits of data, a 3-byte (21-bit) "frequency data word" is used for specifying a frequency with the suggested resolution. 
+    if jobs is None:
+        jobs = available_cores()
+    jobs = max(1, min(jobs, len(batch)))
 
-The first byte of the frequency data word specifies the nearest equal-tempered semitone below the frequency. 
+    if jobs == 1:
+        results = map(convert_job, batch)
+    else:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        results = executor.map(convert_job, batch, chunksize=max(1, len(batch) // (jobs * 8)))
 
-The next two bytes (14 bits) specify the fraction of 100 cents above the semitone at which the frequency lies.
-"""
+    counts = {"written": 0, "skipped": 0, "failed": 0}
+    decoders = Counter()
+    for input_file, output_file, status, message, decoder, timings in results:
+        counts[status] += 1
+        if decoder is not None:
+            decoders[decoder] += 1
+        if timings is not None:
+            timer.merge(timings)
+        if status == "failed":
+            print("Failed " + input_file + " (" + message + ")")
 
-# function to convert frequency to frequency data
-def hz_to_freq_data(freq):
-    # limit freq to bounds of MIDI note range
-    if freq < 8.1757989156:
-        freq = 8.1757989156
-    elif freq > 12543.853951:
-        freq = 12543.853951
-        
-    # calculate the nearest equal-tempered semitone below the frequency
-    semitone = round(12 * math.log(freq/440, 2) + 69)
-    # calculate the fraction of 100 cents above the semitone at which the frequency lies
-    cents = round(1200 * math.log(freq/440, 2) + 6900)
-    cents_fraction = cents - (semitone * 100)
-    if (cents_fraction < 0):
-        semitone = semitone - 1
-        cents_fraction = cents_fraction + 100
-
-    # calculate the MSB of the fractional part
-    # 1 MSB = 1/128 semitone = 100/128 cents = .78125 cents
-    # msb = how many times .78125 fits into cents_fraction
-    msb = int(cents_fraction // .78125)
-    rest = cents_fraction % .78125
-    
-    # calculate the LSB of the fractional part
-    # 1 LSB = 1/16384 semitone = 100/16384 cents = .0061 cents
-    lsb = int(rest // .0061)
-
-    semitone_hex = num_to_hex(semitone)
-    msb_hex = num_to_hex(msb)
-    lsb_hex = num_to_hex(lsb)
-    msb_hex = str(msb_hex)
-    lsb_hex = str(lsb_hex)
-    
-    # return semitone_hex, msb_hex, lsb_hex
-    return semitone_hex + " " + msb_hex + " " + lsb_hex
-    
-
-# calculate freq_data of all notes in scala_freqs
-scala_freq_data = []
-for freq in scala_freqs:
-    freq_data = hz_to_freq_data(freq)
-    scala_freq_data.append(freq_data)
-    
-"""
-The format of the SysEx dump is as follows:
-
-        header = F0 7E 00 08 01 tt tn 
-        tuning_data = <xx yy zz> * 128
-        footer = ck F7
-
-where
-
-        F0 7E = universal non-realtime SysEx header
-        00    = target device ID
-        08    = sub-ID #1 (MIDI tuning standard)
-        01    = sub-ID #2 (bulk dump reply)
-        tt    = tuning program number 0 to 127 in hexadecimal
-        tn    = tuning name (16 ASCII characters)
-        <xx yy zz>    = frequency data for one note,
-                        repeated 128 times, one for each MIDI note number
-        ck    = checksum (XOR of 7E 00 01 tt <388 bytes>)
-        F7    = end of SysEx message
-"""
+    if jobs > 1:
+        executor.shutdown()
 
-# convert program number to hex
-program_number = num_to_hex(program_number)
-# limit scala name to 16 characters and ASCII characters
-scala_name = scala_name[:16]
-scala_name = scala_name.encode('ascii', 'ignore').decode('utf-8')
-# pad scala name with spaces to 16 characters
-scala_name = scala_name.ljust(16)
+    print_summary(counts, decoders)
+    return counts
 
-# convert scala name to hex
-scala_name_hex = []
-for char in scala_name:
-    char_hex = num_to_hex(ord(char))
-    scala_name_hex.append(char_hex)
-# join scala name hex list into string
-scala_name_hex = " ".join(scala_name_hex)
 
+def print_summary(counts, decoders):
+    print("Converted %d, skipped %d, failed %d of %d files" % (counts["written"], counts["skipped"], counts["failed"], sum(counts.values())))
+    if decoders:
+        print("Decoded as " + ", ".join("%s %d" % (decoder, count) for decoder, count in decoders.most_common()))
 
-header = 'F0 7E 00 08 01 ' + str(program_number)+ " " + scala_name_hex
 
+# --------------------------------------------------------
+# archives
 
-data = scala_freq_data
-# convert data to string
-data = ' '.join(data)
+ZIP_EXTENSIONS = (".zip",)
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
 
-footer = "F7"
+# Scala files are a few KB, anything bigger than this is not read into memory
+MAX_MEMBER_SIZE = 1024 * 1024
 
-"""
-Dump messages the checksum field is calculated by successively XOR'ing the bytes in the message, excluding the F0, F7, and the checksum field... The resulting value is then AND'ed with 7F, to create a 7 bit value.
-"""
-# to_checksum = header less the first six chars, plus data, with spaces removed
-to_checksum = header[6:] + ''.join(data).replace(" ", "")
-# XOR of to_checksum
-checksum = functools.reduce(operator.xor, (int(to_checksum[i:i+2], 16) for i in range(0, len(to_checksum), 2)))
-# AND with 7F
-checksum = checksum & 0x7F
-# convert checksum to hex
-checksum = num_to_hex(checksum)
 
+def is_archive(path):
+    return path.lower().endswith(ZIP_EXTENSIONS + TAR_EXTENSIONS)
 
-print('Base note' + ': ' + str(base_note))
-print('Base freq' + ': ' + str(base_freq))
-print('Notes per octave' + ': ' + str(notes_per_octave))
-print('————————————————————')
-print('Intervals')
-# print items in scala_cents with index
-for i, item in enumerate(scala_cents):
-    item = round(float(item), 3)
-    print(str(i+1) + " = " + str(item))
-print('————————————————————')
 
+# yield (name, data, mtime) for every .scl member, reading one member at a time
+def iter_archive(path):
+    if path.lower().endswith(ZIP_EXTENSIONS):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(".scl"):
+                    continue
+                # zip times are local time without a time zone, like time.localtime()
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                if info.file_size > MAX_MEMBER_SIZE:
+                    yield info.filename, None, mtime
+                    continue
+                with archive.open(info) as f:
+                    yield info.filename, f.read(MAX_MEMBER_SIZE + 1), mtime
+    else:
+        # stream mode, the tar is read front to back without seeking
+        with tarfile.open(path, "r|*") as archive:
+            for member in archive:
+                if not member.isfile() or not member.name.lower().endswith(".scl"):
+                    continue
+                if member.size > MAX_MEMBER_SIZE:
+                    yield member.name, None, member.mtime
+                    continue
+                yield member.name, archive.extractfile(member).read(), member.mtime
+
+
+# archive member names are untrusted, keep them relative and inside the output
+def safe_member_name(name):
+    name = os.path.normpath(name.replace("\\", "/")).lstrip("/")
+    if name == ".." or name.startswith("../"):
+        raise Exception(name + " points outside the archive")
+    return name
+
+
+# yield (label, path relative to the output, data, mtime) for every Scala file in the given paths and archives
+def iter_scala_sources(paths):
+    for path in paths:
+        if os.path.isfile(path) and is_archive(path):
+            for name, data, mtime in iter_archive(path):
+                yield path + ":" + name, name, data, mtime
+        else:
+            for input_file, relative_path in find_scala_files([path]):
+                with open(input_file, "rb") as f:
+                    yield input_file, relative_path, f.read(MAX_MEMBER_SIZE + 1), os.path.getmtime(input_file)
 
-# sysex
-sysex = header + " " + data + " " + checksum + " " + footer
 
-# remove spaces from sysex
-sysex = sysex.replace(" ", "")
+# writes members into a .zip or .tar output archive, one at a time
+class ArchiveWriter:
+    def __init__(self, path):
+        self.is_zip = path.lower().endswith(ZIP_EXTENSIONS)
+        if self.is_zip:
+            self.archive = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        else:
+            compression = {".gz": "gz", ".tgz": "gz", ".bz2": "bz2", ".tbz2": "bz2", ".xz": "xz", ".txz": "xz"}.get(os.path.splitext(path.lower())[1], "")
+            self.archive = tarfile.open(path, "w|" + compression)
+        self.names = set()
+
+    def write(self, name, data):
+        if name in self.names:
+            raise Exception(name + " is already in the output archive")
+        self.names.add(name)
+        if self.is_zip:
+            self.archive.writestr(zipfile.ZipInfo(name, time.localtime()[:6]), data, zipfile.ZIP_DEFLATED)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.archive.close()
+
+
+def convert_stream(paths, output, base_note, base_freq, program_number, overwrite="never", timer=None):
+    counts = {"written": 0, "skipped": 0, "failed": 0}
+    decoders = Counter()
+
+    writer = None
+    if output is not None and is_archive(output):
+        # an output archive is rewritten as a whole, its members can't be kept or compared one by one
+        if os.path.exists(output) and overwrite != "always":
+            print("Output archive " + output + " already exists, use --overwrite always to replace it")
+            counts["failed"] += 1
+            return counts
+        writer = ArchiveWriter(output)
+    elif output is None and any(is_archive(path) for path in paths):
+        print("Error: -o output directory or archive is required for archive inputs")
+        counts["failed"] += 1
+        return counts
+
+    try:
+        for label, relative_path, data, mtime in iter_scala_sources(paths):
+            try:
+                output_name = os.path.splitext(safe_member_name(relative_path))[0] + ".syx"
+                if data is None or len(data) > MAX_MEMBER_SIZE:
+                    raise Exception("file is larger than %d bytes" % MAX_MEMBER_SIZE)
+                if writer is None:
+                    if output is None:
+                        output_file = os.path.splitext(label)[0] + ".syx"
+                    else:
+                        output_file = os.path.join(output, output_name)
+                    if not should_write_mtime(mtime, output_file, overwrite):
+                        counts["skipped"] += 1
+                        continue
+                if timer is not None:
+                    timer.restart()
+                text, decoder = mtsengine.decode_scala_with_decoder(data)
+                decoders[decoder] += 1
+                if timer is not None:
+                    timer.lap('decode')
+                sysex = mtsengine.scl_to_syx(text, program_number, base_note, base_freq, timer)
+                if writer is None:
+                    if os.path.dirname(output_file):
+                        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+                    with open(output_file, "wb") as f:
+                        f.write(sysex)
+                else:
+                    writer.write(output_name, sysex)
+                if timer is not None:
+                    timer.lap('write')
+                counts["written"] += 1
+            except Exception as e:
+                counts["failed"] += 1
+                print("Failed " + label + " (%s: %s)" % (type(e).__name__, e))
+    finally:
+        if writer is not None:
+            writer.close()
+
+    print_summary(counts, decoders)
+    return counts
+
+
+# --------------------------------------------------------
+# banks
+
+# whether a command line value is a program number from 0 to 127
+def is_program_number(value):
+    return mtsengine.is_whole_number(value) and int(value) <= 127
+
+
+# "0-3,7" -> [0, 1, 2, 3, 7], raises ValueError for anything else
+def parse_slots(slots):
+    program_numbers = []
+    for part in slots.split(","):
+        first, dash, last = part.strip().partition("-")
+        if not is_program_number(first) or (dash and not is_program_number(last)):
+            raise ValueError("%r is not a program number from 0 to 127 or a range of them" % part)
+        if dash:
+            if int(first) > int(last):
+                raise ValueError("%r is an empty range" % part)
+            program_numbers.extend(range(int(first), int(last) + 1))
+        else:
+            program_numbers.append(int(first))
+    return program_numbers
+
+
+# convert every scale once and pack them into consecutive slots of one bank file
+def convert_bank(paths, bank_file, base_note, base_freq, first_program_number, overwrite="never"):
+    counts = {"written": 0, "skipped": 0, "failed": 0}
+    decoders = Counter()
+
+    if os.path.exists(bank_file) and overwrite == "never":
+        print("Bank file " + bank_file + " already exists, use --overwrite always to replace it")
+        counts["failed"] += 1
+        return counts
+
+    dumps = []
+    for label, relative_path, data, mtime in iter_scala_sources(paths):
+        try:
+            if data is None or len(data) > MAX_MEMBER_SIZE:
+                raise Exception("file is larger than %d bytes" % MAX_MEMBER_SIZE)
+            text, decoder = mtsengine.decode_scala_with_decoder(data)
+            decoders[decoder] += 1
+            dumps.append(mtsengine.scl_to_syx(text, 0, base_note, base_freq))
+            print(str(first_program_number + len(dumps) - 1) + " = " + label)
+        except Exception as e:
+            counts["failed"] += 1
+            print("Failed " + label + " (%s: %s)" % (type(e).__name__, e))
+
+    program_numbers = range(first_program_number, first_program_number + len(dumps))
+    if program_numbers and program_numbers[-1] > 127:
+        print("Error: %d scales don't fit in the slots from %d to 127" % (len(dumps), first_program_number))
+        counts["failed"] += len(dumps)
+        return counts
+
+    with open(bank_file, "wb") as f:
+        f.write(mtsengine.build_bank(dumps, program_numbers))
+    counts["written"] = len(dumps)
+
+    print_summary(counts, decoders)
+    print("Wrote bank to " + bank_file)
+    return counts
+
+
+# --------------------------------------------------------
+# decoding
+
+def decode_syx_files(paths, output_directory=None, base_note=60, overwrite="never"):
+    counts = {"dumps": 0, "bad checksums": 0, "failed": 0}
+    for input_file, relative_path in find_scala_files(paths, (".syx",)):
+        try:
+            dumps = mtsengine.read_syx_file(input_file)
+        except Exception as e:
+            counts["failed"] += 1
+            print("Failed " + input_file + " (%s: %s)" % (type(e).__name__, e))
+            continue
+        if not dumps:
+            print(input_file + ": no bulk tuning dumps")
+        for dump in dumps:
+            counts["dumps"] += 1
+            if not dump.checksum_ok:
+                counts["bad checksums"] += 1
+            print("%s @%d: program %d, %r, checksum %s" % (input_file, dump.offset, dump.program_number, dump.name, "ok" if dump.checksum_ok else "BAD"))
+            if output_directory is None:
+                continue
+
+            output_name = os.path.splitext(relative_path)[0]
+            if len(dumps) > 1:
+                output_name += "-p" + str(dump.program_number)
+            output_file = os.path.join(output_directory, output_name + ".scl")
+            if os.path.exists(output_file) and overwrite == "never":
+                continue
+            text, scala_base_note, scala_base_freq = mtsengine.bulk_dump_to_scala(dump, base_note, os.path.basename(output_file))
+            if os.path.dirname(output_file):
+                os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            with open(output_file, "w") as f:
+                f.write(text)
+            print("    wrote " + output_file + " (base note %d, base freq %.6f)" % (scala_base_note, scala_base_freq))
+
+    print("%d dumps, %d bad checksums, %d unreadable files" % (counts["dumps"], counts["bad checksums"], counts["failed"]))
+    return counts
+
+
+# --------------------------------------------------------
+
+# convert every Scala file in paths and archives once into a scale store
+def build_scale_store(paths, store_file, base_note=69, base_freq=440):
+    start_time = time.time()
+    skipped = []
+
+    def sources():
+        for label, relative_path, data, mtime in iter_scala_sources(paths):
+            if data is None or len(data) > MAX_MEMBER_SIZE:
+                skipped.append(label)
+                continue
+            yield relative_path, data
+
+    stored, failed = mtsstore.build_store(sources(), store_file, base_note, base_freq)
+    for name, error in failed:
+        print("Skipped " + name + ": " + error)
+    for label in skipped:
+        print("Skipped " + label + ": larger than %d bytes" % MAX_MEMBER_SIZE)
+    print("Stored %d scales in %s (%d bytes) in %.2f s, %d skipped" % (stored, store_file, os.path.getsize(store_file), time.time() - start_time, len(failed) + len(skipped)))
+    return {"stored": stored, "failed": len(failed) + len(skipped)}
+
+
+# print the scales in a store closest to a Scala file or a list of cents
+def find_similar(store_file, input_file=None, query_cents=None, count=10):
+    if (input_file is None) == (query_cents is None):
+        print("Error: --similar needs either -i or --cents")
+        sys.exit(2)
+    try:
+        if input_file is not None:
+            scala_cents = mtsengine.scala_tuning(mtsengine.read_scala_file(input_file)).cents
+        else:
+            scala_cents = mtsstore.parse_cents_list(query_cents)
+    except mtsengine.ScalaError as e:
+        print("Error: " + str(e))
+        sys.exit(1)
+
+    store = mtsstore.ScaleStore(store_file)
+    start_time = time.time()
+    index = mtsstore.SimilarityIndex(store)
+    index_time = time.time()
+    matches = index.nearest(scala_cents, count)
+    print("%d note scales closest to %s (index built in %.1f ms, searched in %.1f ms)" % (len(scala_cents), input_file or query_cents, (index_time - start_time) * 1000, (time.time() - index_time) * 1000))
+    for match in matches:
+        print("%10.3f cents  %s (mode %d)" % (match.distance, match.name, match.mode))
+    return matches
+
+
+# --------------------------------------------------------
+
+def main(argv):
+    # define defaults
+    input_file = None
+    output_file = None
+    program_number = 1
+    overwrite = "never"
+    jobs = None
+    slots = None
+    bank_file = None
+    from_file = None
+    scale_octave_form = None
+    decode = False
+    base_note_given = False
+    store_file = None
+    similar_store = None
+    query_cents = None
+    similar_count = 10
+    timer = None
+
+    base_note = 69
+    base_freq = 440
+    # base_note = 48
+    # base_freq = 261.625565
+
+    # parse command line arguments
+    try:
+        opts, args = getopt.gnu_getopt(argv, "hi:o:n:f:p:j:k:", ["help", "input=", "output=", "base_note=", "base_freq=", "program_number=", "jobs=", "overwrite=", "slots=", "bank=", "from=", "scale-octave=", "verify", "decode", "build-store=", "similar=", "cents=", "profile"])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print(__doc__)
+            sys.exit()
+        elif o in ("-i", "--input"):
+            input_file = a
+        elif o in ("-o", "--output"):
+            output_file = a
+        elif o in ("-n", "--base_note"):
+            base_note = int(a)
+            base_note_given = True
+        elif o in ("-f", "--base_freq"):
+            base_freq = float(a)
+        elif o in ("-p", "--program_number"):
+            # first is actually 0
+            if not is_program_number(a):
+                print("Error: -p must be a program number from 0 to 127")
+                sys.exit(2)
+            program_number = int(a)
+        elif o in ("-j", "--jobs"):
+            jobs = int(a)
+        elif o == "--slots":
+            try:
+                slots = parse_slots(a)
+            except ValueError as e:
+                print("Error: --slots " + str(e))
+                sys.exit(2)
+        elif o == "--bank":
+            bank_file = a
+        elif o == "--from":
+            from_file = a
+        elif o == "--decode":
+            decode = True
+        elif o == "--build-store":
+            store_file = a
+        elif o == "--similar":
+            similar_store = a
+        elif o == "--cents":
+            query_cents = a
+        elif o == "-k":
+            similar_count = int(a)
+        elif o == "--profile":
+            timer = mtsengine.StageTimer()
+        elif o == "--verify":
+            max_error = mtsengine.verify_freq_data()
+            # half of the 1/16384 semitone resolution is the best possible
+            print("Largest frequency data error: %.6f cents (resolution %.6f cents)" % (max_error, 100 / 16384))
+            sys.exit(0 if max_error <= 50 / 16384 + 1e-9 else 1)
+        elif o == "--scale-octave":
+            if a not in ("1", "2"):
+                print("Error: --scale-octave must be 1 or 2")
+                sys.exit(2)
+            scale_octave_form = int(a)
+        elif o == "--overwrite":
+            if a not in OVERWRITE_POLICIES:
+                print("Error: --overwrite must be one of " + ", ".join(OVERWRITE_POLICIES))
+                sys.exit(2)
+            overwrite = a
+        else:
+            assert False, "unhandled option"
 
-# sysex_print = add space every four chars
-sysex_print = ' '.join(sysex[i:i+4] for i in range(0, len(sysex), 4))
-# break sys ex into lines of 70 chars
-sysex_print = textwrap.wrap(sysex_print, 70)
+    # check if any flags are specified
+    if len(opts) == 0 and len(args) == 0:
+        print(__doc__)
+        sys.exit()
 
-# print sysex_print
-for line in sysex_print:
-    print(line)
-    
-print('————————————————————')
+    if decode:
+        counts = decode_syx_files(args, output_file, base_note if base_note_given else 60, overwrite)
+        sys.exit(1 if counts["bad checksums"] or counts["failed"] else 0)
 
+    if similar_store is not None:
+        find_similar(similar_store, input_file, query_cents, similar_count)
+        sys.exit()
 
-# convert sysex to bytes
-sysex = bytes.fromhex(sysex)
+    if store_file is not None:
+        counts = build_scale_store(args, store_file, base_note, base_freq)
+        sys.exit(1 if counts["stored"] == 0 else 0)
+
+    # batch mode, directories and glob patterns
+    if args and bank_file is not None:
+        counts = convert_bank(args, bank_file, base_note, base_freq, program_number, overwrite)
+        sys.exit(1 if counts["failed"] else 0)
+    if args:
+        counts = convert_batch(args, output_file, base_note, base_freq, program_number, overwrite, jobs, timer)
+        if timer is not None:
+            print()
+            print("Summed over all files:")
+            print(timer.report())
+        sys.exit(1 if counts["failed"] else 0)
+
+    # check for required arguments
+    if input_file is None:
+        print("Error: input file is required")
+        sys.exit(2)
+
+    if sum(option is not None for option in (from_file, slots, scale_octave_form)) > 1:
+        print("Error: --from, --slots and --scale-octave can't be combined")
+        sys.exit(2)
+
+    # set output file name if not specified
+    if output_file is None:
+        # replace the file extension with .syx
+        output_file = os.path.splitext(input_file)[0] + ".syx"
+
+    # run the conversion stage by stage, so the intervals can be printed
+    try:
+        tuning = mtsengine.scala_tuning(mtsengine.read_scala_file(input_file, timer), base_note, base_freq, timer)
+    except mtsengine.ScalaError as e:
+        print("Error: " + input_file + " " + str(e))
+        sys.exit(1)
+    scale = tuning.scale
+    scala_cents = tuning.cents
+    if from_file is not None:
+        # only the notes that differ from the tuning that is already loaded
+        try:
+            old_tuning = mtsengine.scala_tuning(mtsengine.read_scala_file(from_file), base_note, base_freq)
+        except mtsengine.ScalaError as e:
+            print("Error: " + from_file + " " + str(e))
+            sys.exit(1)
+        changes = mtsengine.diff_freq_data(old_tuning.freq_data, tuning.freq_data)
+        if not changes:
+            print("No notes differ from " + from_file + ", nothing to send")
+            sys.exit(0)
+        sysex = mtsengine.build_note_changes(changes, program_number)
+        # 10 bits per byte at 31250 baud
+        print("%d notes differ from %s, %d bytes (%.1f ms), bulk dump is %d bytes (%.1f ms)" % (len(changes), from_file, len(sysex), len(sysex) * 10 / 31.25, mtsengine.BULK_DUMP_LENGTH, mtsengine.BULK_DUMP_LENGTH * 10 / 31.25))
+    elif scale_octave_form is not None:
+        scale_octave = mtsengine.scale_octave_tuning(tuning, scale_octave_form)
+        if scale_octave is None:
+            print("Error: this scale and base note can't be expressed as a %d byte scale/octave tuning" % scale_octave_form)
+            sys.exit(2)
+        sysex, max_error = scale_octave
+        print("Scale/octave tuning, %d byte form: %d bytes, at most %.3f cents from the bulk dump" % (scale_octave_form, len(sysex), max_error))
+    else:
+        if timer is not None:
+            timer.restart()
+        sysex = mtsengine.build_sysex(scale.name, tuning.freq_data, program_number)
+        if timer is not None:
+            timer.lap('sysex')
+        # offer the much shorter message when it fits
+        for form in (1, 2):
+            scale_octave = mtsengine.scale_octave_tuning(tuning, form)
+            if scale_octave is not None:
+                print("This tuning fits a %d byte scale/octave tuning message (--scale-octave %d): %d bytes, at most %.3f cents from the bulk dump" % (form, form, len(scale_octave[0]), scale_octave[1]))
+    if slots is not None:
+        # the same tuning in every slot, only the program number and checksum differ
+        sysex = mtsengine.build_bank([sysex] * len(slots), slots)
+
+    print('Base note' + ': ' + str(base_note))
+    print('Base freq' + ': ' + str(base_freq))
+    print('Notes per octave' + ': ' + str(scale.notes_per_octave))
+    print('————————————————————')
+    print('Intervals')
+    # print items in scala_cents with index
+    for i, item in enumerate(scala_cents):
+        item = round(float(item), 3)
+        print(str(i+1) + " = " + str(item))
+    print('————————————————————')
+
+    # sysex_print = add space every four chars
+    sysex_hex = sysex.hex()
+    sysex_print = ' '.join(sysex_hex[i:i+4] for i in range(0, len(sysex_hex), 4))
+    # break sys ex into lines of 70 chars
+    for line in textwrap.wrap(sysex_print, 70):
+        print(line)
+
+    print('————————————————————')
+    print()
+
+    # check if output_file exists
+    if os.path.isfile(output_file):
+        print("Output file " + output_file + " already exists. Overwrite? (y/n) [enter]")
+        overwrite = input()
+        if overwrite == "y":
+            write_file(sysex, output_file, timer)
+        else:
+            print("Aborting.")
+    else:
+        write_file(sysex, output_file, timer)
 
-print()
+    if timer is not None:
+        print()
+        print(timer.report())
 
-def write_file(sysex):
-    # open output_file in binary write mode
-    f = open(output_file, "wb")
-    # write sysex to output_file
-    f.write(sysex)
-    f.close()
-    print("Wrote sysex to " + output_file)
 
-# check if output_file exists
-if os.path.isfile(output_file):
-    print("Output file " + output_file + " already exists. Overwrite? (y/n) [enter]")
-    overwrite = input()
-    if overwrite == "y":
-        write_file(sysex)
-    else:
-        print("Aborting.")
-else:
-    write_file(sysex)
+if __name__ == '__main__':
+    main(sys.argv[1:])
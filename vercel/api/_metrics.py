@@ -0,0 +1,107 @@
+# Author: Olle Holmberg, 2022-2023
+# License: GPL v3
+#
+# https://github.com/unremarkablegarden/scala2mts
+
+
+"""
+Request counts and latency histograms of the web app, rendered in the
+Prometheus text format for /metrics. Every instance counts its own
+requests, from when it started.
+"""
+
+import threading
+from bisect import bisect_left
+
+
+# seconds, from the cheapest stage of a small scale to a slow cold request
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# bytes, most Scala files are under 4 kB
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+OUTCOMES = ('success', 'parse_error', 'invalid_params', 'too_large', 'no_file', 'error')
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # the first bucket with an upper bound (le) of at least value, or +Inf
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels=''):
+        separator = ',' if labels else ''
+        cumulative = 0
+        lines = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, separator, bound, cumulative))
+        labels = '{' + labels + '}' if labels else ''
+        lines.append('%s_sum%s %r' % (name, labels, self.sum))
+        lines.append('%s_count%s %d' % (name, labels, self.count))
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = dict((outcome, 0) for outcome in OUTCOMES)
+        self.stages = {}
+        self.upload_sizes = Histogram(SIZE_BUCKETS)
+
+    # one conversion request: its outcome, the size of the upload (None if it wasn't read),
+    # and the seconds spent in each stage from a StageTimer
+    def observe_conversion(self, outcome, upload_size, timings):
+        with self.lock:
+            self.requests[outcome] = self.requests.get(outcome, 0) + 1
+            if upload_size is not None:
+                self.upload_sizes.observe(upload_size)
+            for stage, seconds in list(timings.items()) + [('total', sum(timings.values()))]:
+                if stage not in self.stages:
+                    self.stages[stage] = Histogram(LATENCY_BUCKETS)
+                self.stages[stage].observe(seconds)
+
+    # the Prometheus text exposition format, cache_stats is ResultCache.stats()
+    def render(self, cache_stats):
+        lines = [
+            '# HELP scala2mts_requests_total Conversion requests by outcome.',
+            '# TYPE scala2mts_requests_total counter',
+        ]
+        with self.lock:
+            for outcome, count in self.requests.items():
+                lines.append('scala2mts_requests_total{outcome="%s"} %d' % (outcome, count))
+
+            lines += [
+                '# HELP scala2mts_stage_seconds Time spent in each stage of a conversion request.',
+                '# TYPE scala2mts_stage_seconds histogram',
+            ]
+            for stage, histogram in self.stages.items():
+                lines += histogram.lines('scala2mts_stage_seconds', 'stage="%s"' % stage)
+
+            lines += [
+                '# HELP scala2mts_upload_bytes Size of the uploaded Scala files.',
+                '# TYPE scala2mts_upload_bytes histogram',
+            ]
+            lines += self.upload_sizes.lines('scala2mts_upload_bytes')
+
+        lines += [
+            '# HELP scala2mts_cache_hits_total Conversions answered from the result cache.',
+            '# TYPE scala2mts_cache_hits_total counter',
+            'scala2mts_cache_hits_total %d' % cache_stats['hits'],
+            '# HELP scala2mts_cache_misses_total Conversions not in the result cache.',
+            '# TYPE scala2mts_cache_misses_total counter',
+            'scala2mts_cache_misses_total %d' % cache_stats['misses'],
+            '# HELP scala2mts_cache_hit_ratio Share of cache lookups that were hits.',
+            '# TYPE scala2mts_cache_hit_ratio gauge',
+            'scala2mts_cache_hit_ratio %r' % cache_stats['hit_ratio'],
+            '# HELP scala2mts_cache_entries Conversions in the result cache.',
+            '# TYPE scala2mts_cache_entries gauge',
+            'scala2mts_cache_entries %d' % cache_stats['entries'],
+        ]
+        return '\n'.join(lines) + '\n'
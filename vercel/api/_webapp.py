@@ -0,0 +1,346 @@
+# Author: Olle Holmberg, 2022-2023
+# License: GPL v3
+# v0.0.51 - 2023-11-08
+# 
+# https://github.com/unremarkablegarden/scala2mts
+
+
+# The Flask app, imported by index.py on the first request that isn't a
+# pre-rendered page or a static file.
+
+import os, sys, time, math, hashlib, threading
+from collections import OrderedDict
+from flask import Flask, Request, render_template, request, Response, jsonify, abort, after_this_request, g
+
+# the conversion engine lives next to this file when deployed, and in the repository root when run from a checkout
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from mtsengine import decode_scala, scl_to_syx, scala_tuning, ScalaError, StageTimer
+from mtsstore import ScaleStore, SimilarityIndex, parse_cents_list
+from _metrics import Metrics
+
+class UploadRequest(Request):
+    # the form fields besides the file are a few short numbers, set on the class
+    # because the MAX_FORM_MEMORY_SIZE and MAX_FORM_PARTS config keys only exist from Flask 3.1
+    max_form_memory_size = 64 * 1024
+    max_form_parts = 16
+
+
+app = Flask(__name__, 
+            static_folder='./static', 
+            static_url_path=''
+        )
+app.request_class = UploadRequest
+
+# Scala files are a few kB, anything much bigger is rejected with a 413 while it is read,
+# before it fills the memory of a small instance (werkzeug checks the Content-Length
+# up front, and counts the bytes of bodies sent without one)
+MAX_UPLOAD_SIZE = int(os.environ.get('SCALA2MTS_MAX_UPLOAD', 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE + 64 * 1024  # the other form fields and multipart headers
+
+# time every stage of a conversion and send it in a Server-Timing header, set to 0 to turn it off
+SERVER_TIMING = os.environ.get('SCALA2MTS_SERVER_TIMING', '1') != '0'
+# count conversions and their stage timings for /metrics, set to 0 to turn it off
+METRICS = os.environ.get('SCALA2MTS_METRICS', '1') != '0'
+
+metrics = Metrics()
+
+# --------------------------------------------------------
+
+class ResultCache:
+    """
+    LRU cache of converted .syx files, keyed by a hash of the uploaded
+    bytes and the conversion parameters. Entries expire after ttl seconds.
+    """
+
+    def __init__(self, max_entries=256, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(file_content, program_number, base_note, base_freq):
+        digest = hashlib.sha256(file_content)
+        digest.update(("|%d|%d|%r" % (program_number, base_note, base_freq)).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, key, sysex, etag):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, sysex, etag)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+            }
+
+
+result_cache = ResultCache(
+    max_entries=int(os.environ.get('SCALA2MTS_CACHE_ENTRIES', 256)),
+    ttl=float(os.environ.get('SCALA2MTS_CACHE_TTL', 3600)),
+)
+
+# precompiled archive scales, built with scala2mts.py --build-store,
+# memory-mapped once so every worker shares the same pages
+def open_scale_store(path):
+    if not os.path.isfile(path):
+        return None
+    try:
+        return ScaleStore(path)
+    except (OSError, ValueError) as e:
+        app.logger.error("Could not open scale store %s: %s" % (path, e))
+        return None
+
+
+scale_store = open_scale_store(os.environ.get('SCALA2MTS_STORE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scales.store')))
+
+# built on the first search, not at startup
+similarity_index = None
+similarity_index_lock = threading.Lock()
+
+
+def get_similarity_index():
+    global similarity_index
+    with similarity_index_lock:
+        if similarity_index is None:
+            similarity_index = SimilarityIndex(scale_store)
+        return similarity_index
+
+# --------------------------------------------------------
+
+@app.route('/', methods=['GET', 'POST'])
+def home():
+    if request.method == 'POST':
+        timer = None
+        if SERVER_TIMING or METRICS:
+            timer = StageTimer()
+
+            # on every response, errors included
+            @after_this_request
+            def finish_conversion(response):
+                if SERVER_TIMING:
+                    response.headers['Server-Timing'] = timer.server_timing()
+                if METRICS:
+                    outcome = conversion_outcome(response)
+                    # a rejected upload was never read, its declared size is all there is
+                    upload_size = request.content_length if outcome == 'too_large' else g.get('upload_size')
+                    metrics.observe_conversion(outcome, upload_size, timer.timings)
+                return response
+
+        file = request.files.get('file')
+        if file:
+            try:
+                program_number, base_note, base_freq = conversion_params(request.form)
+            except ValueError:
+                g.outcome = 'invalid_params'
+                return "Invalid input. Please provide valid numbers."
+
+            if timer is not None:
+                timer.restart()
+            file_content = read_upload(file)
+            g.upload_size = len(file_content)
+            output_filename = file.filename + "-p" + str(program_number) + ".syx"
+            if timer is not None:
+                timer.lap('upload')
+
+            cache_key = ResultCache.key(file_content, program_number, base_note, base_freq)
+            cached = result_cache.get(cache_key)
+            if timer is not None:
+                timer.lap('cache')
+            if cached is None:
+                # archive scales are already converted, skip decoding and parsing
+                stored = scale_store.find_content(file_content) if scale_store is not None else None
+                if stored is not None:
+                    output_file = scale_store.sysex(stored, program_number, base_note, base_freq)
+                    if timer is not None:
+                        timer.lap('store')
+                else:
+                    text = convert_to_utf8(file_content)
+                    if timer is not None:
+                        timer.lap('decode')
+                    try:
+                        output_file = scl_to_syx(text, program_number, base_note, base_freq, timer)
+                    except ScalaError as e:
+                        g.outcome = 'parse_error'
+                        return 'Error: could not read the Scala file, ' + str(e), 400
+                etag = hashlib.sha256(output_file).hexdigest()[:32]
+                result_cache.put(cache_key, output_file, etag)
+            else:
+                output_file, etag = cached
+
+            # the ETag identifies the bytes, but If-None-Match isn't evaluated here:
+            # 304 is only for GET and HEAD (RFC 9110 13.1.2), and POST responses aren't cached anyway
+            return stream_file(output_file, output_filename, etag)
+            
+        else:
+            g.outcome = 'no_file'
+            return 'Error: No file uploaded'
+        
+    return render_template('upload.html')
+
+
+@app.route('/scales/<name>.syx')
+def archive_scale(name):
+    if scale_store is None:
+        return page_not_found(None)
+    stored = scale_store.find_name(name)
+    if stored is None:
+        return page_not_found(None)
+    try:
+        program_number, base_note, base_freq = conversion_params(request.args, scale_store.base_note, scale_store.base_freq)
+        output_file = scale_store.sysex(stored, program_number, base_note, base_freq)
+    except ValueError:
+        return "Invalid input. Please provide valid numbers.", 400
+
+    etag = hashlib.sha256(output_file).hexdigest()[:32]
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return stream_file(output_file, name + "-p" + str(program_number) + ".syx", etag)
+
+
+@app.route('/similar', methods=['POST'])
+def similar():
+    if scale_store is None:
+        return jsonify({'error': 'No scale archive available'}), 404
+    try:
+        k = min(int(request.form.get('k', 10)), 100)
+    except ValueError:
+        return jsonify({'error': 'Invalid input. Please provide valid numbers.'}), 400
+
+    # the same decoding and cents as a conversion, or a plain list of cents
+    file = request.files.get('file')
+    try:
+        if file:
+            scala_cents = scala_tuning(convert_to_utf8(read_upload(file))).cents
+        elif request.form.get('cents'):
+            scala_cents = parse_cents_list(request.form['cents'])
+        else:
+            return jsonify({'error': 'No file or cents uploaded'}), 400
+    except ScalaError as e:
+        return jsonify({'error': 'could not read the Scala file, ' + str(e)}), 400
+
+    matches = get_similarity_index().nearest(scala_cents, k)
+    return jsonify({
+        'notes': len(scala_cents),
+        'matches': [{'name': match.name, 'distance': match.distance, 'mode': match.mode} for match in matches],
+    })
+
+
+@app.route('/cache-stats')
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if not METRICS:
+        return page_not_found(None)
+    return Response(metrics.render(result_cache.stats()), mimetype='text/plain; version=0.0.4')
+
+
+# the program number, base note and base frequency of a form or query string,
+# raises ValueError for anything that isn't a number a bulk dump can hold
+def conversion_params(values, base_note=69, base_freq=440):
+    program_number = int(values.get('program_number', 1))
+    base_note = int(values.get('base_note', base_note))
+    base_freq = float(values.get('base_freq', base_freq))
+    if not 0 <= program_number <= 127:
+        raise ValueError("the program number must be between 0 and 127")
+    if not math.isfinite(base_freq):
+        raise ValueError("the base frequency must be a finite number")
+    return program_number, base_note, base_freq
+
+
+# what happened to a conversion request, for the metrics
+def conversion_outcome(response):
+    if response.status_code == 413:
+        return 'too_large'
+    if 'outcome' in g:
+        return g.outcome
+    return 'success' if response.status_code < 400 else 'error'
+
+
+
+# --------------------------------------------------------
+@app.errorhandler(404)
+def page_not_found(e):
+    return render_template('404.html'), 404
+# --------------------------------------------------------
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    return 'Error: the file is too large, Scala files can be at most %d bytes' % MAX_UPLOAD_SIZE, 413
+# --------------------------------------------------------
+@app.errorhandler(500)
+def internal_server_error(e):
+    app.logger.error(str(e))
+    error_message = str(e)
+    return render_template('500.html', error=error_message), 500
+# --------------------------------------------------------
+
+
+# the result is a few hundred bytes, sent in one piece with its Content-Length
+def stream_file(output_file, output_filename, etag=None):
+    response = Response(output_file, mimetype='application/octet-stream')
+    response.headers.set('Content-Disposition', 'attachment', filename=output_filename)
+    if etag is not None:
+        # strong ETag, the same etag always means the same bytes
+        response.set_etag(etag)
+        response.headers.set('Cache-Control', 'no-cache')
+    return response
+
+# --------------------------------------------------------
+
+# read an uploaded file in chunks, stopping with a 413 as soon as it is larger than MAX_UPLOAD_SIZE
+def read_upload(file):
+    file_content = bytearray()
+    while True:
+        chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        file_content += chunk
+        if len(file_content) > MAX_UPLOAD_SIZE:
+            abort(413)
+    return bytes(file_content)
+
+# --------------------------------------------------------
+
+def convert_to_utf8(file_content):
+    # Convert the binary content of the file to text
+    return decode_scala(file_content)
+
+# --------------------------------------------------------
+
+if __name__ == '__main__':
+    # app.run()
+    app.run(debug=True)
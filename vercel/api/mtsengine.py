@@ -0,0 +1 @@
+../../mtsengine.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../mtsstore.py
\ No newline at end of file
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Path: vercel/check_import_time.py
+# Author: Olle Holmberg, 2022-2023
+# License: GPL v3
+#
+# https://github.com/unremarkablegarden/scala2mts
+
+
+"""
+Check that importing the Vercel entry point (api/index.py) stays cheap, as
+every cold start pays for it before answering its first request.
+
+Imports it in a fresh interpreter with python -X importtime, fails if it
+imports any of the heavy modules below or takes longer than the budget
+(the best of several runs, so a busy machine doesn't fail it).
+
+python vercel/check_import_time.py [-b budget in ms] [-r runs] [-v]
+
+-b budget: the import time budget in milliseconds (default: 10)
+-r runs: how many fresh interpreters to measure (default: 5)
+-v verbose: print the slowest imports of the best run
+"""
+
+import os
+import sys
+import getopt
+import subprocess
+
+API_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api')
+
+ENTRY_POINT = 'index'
+
+# only imported by the first request that needs them
+HEAVY_MODULES = ('flask', 'werkzeug', 'jinja2', 'chardet', 'numpy', 'mtsengine', 'mtsstore', '_webapp')
+
+
+# one fresh import of the entry point,
+# returns the total import time in ms and a list of (cumulative ms, module) for everything imported
+def measure_import():
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + ENTRY_POINT],
+        cwd=API_DIRECTORY, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise Exception("importing %s failed:\n%s" % (ENTRY_POINT, result.stderr))
+
+    modules = []
+    total = None
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((int(cumulative) / 1000, name.strip()))
+        if name.strip() == ENTRY_POINT:
+            total = int(cumulative) / 1000
+    return total, modules
+
+
+def main(argv):
+    budget = 10.0
+    runs = 5
+    verbose = False
+
+    try:
+        opts, args = getopt.getopt(argv, "hb:r:v", ["help", "budget=", "runs=", "verbose"])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print(__doc__)
+            sys.exit()
+        elif o in ("-b", "--budget"):
+            budget = float(a)
+        elif o in ("-r", "--runs"):
+            runs = int(a)
+        elif o in ("-v", "--verbose"):
+            verbose = True
+
+    best, best_modules = min(measure_import() for run in range(runs))
+
+    heavy = sorted(set(name for cumulative, name in best_modules if name.split('.')[0] in HEAVY_MODULES))
+    if verbose or heavy:
+        for cumulative, name in sorted(best_modules, reverse=True)[:15]:
+            print("%8.2f ms  %s" % (cumulative, name))
+
+    print("Importing %s takes %.2f ms (best of %d), budget %.2f ms" % (ENTRY_POINT, best, runs, budget))
+    if heavy:
+        print("Error: %s imports %s at startup" % (ENTRY_POINT, ", ".join(heavy)))
+    if best > budget:
+        print("Error: over budget")
+    sys.exit(1 if heavy or best > budget else 0)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Path: vercel/prerender.py
+# Author: Olle Holmberg, 2022-2023
+# License: GPL v3
+#
+# https://github.com/unremarkablegarden/scala2mts
+
+
+"""
+Render the templates that don't depend on the request to static HTML in
+api/prerendered/, which api/index.py serves without importing Flask.
+Run it after changing one of them, and commit the result.
+
+python vercel/prerender.py [--check]
+
+--check: don't write anything, exit with 1 if a pre-rendered page is out of date
+"""
+
+import os
+import sys
+import getopt
+
+API_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api')
+sys.path.insert(0, API_DIRECTORY)
+
+from index import PRERENDERED_DIRECTORY, PRERENDERED_PAGES
+
+
+# template name -> rendered HTML
+def render_pages():
+    from flask import render_template
+    from _webapp import app
+
+    pages = {}
+    for path, name in PRERENDERED_PAGES.items():
+        with app.test_request_context(path):
+            pages[name] = render_template(name)
+    return pages
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "h", ["help", "check"])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
+
+    check = False
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print(__doc__)
+            sys.exit()
+        elif o == "--check":
+            check = True
+
+    outdated = 0
+    for name, html in render_pages().items():
+        output_file = os.path.join(PRERENDERED_DIRECTORY, name)
+        data = html.encode('utf-8')
+        if os.path.isfile(output_file):
+            with open(output_file, 'rb') as f:
+                if f.read() == data:
+                    continue
+        outdated += 1
+        if check:
+            print(output_file + " is out of date, run python vercel/prerender.py")
+            continue
+        os.makedirs(PRERENDERED_DIRECTORY, exist_ok=True)
+        with open(output_file, 'wb') as f:
+            f.write(data)
+        print("Wrote " + output_file)
+
+    sys.exit(1 if check and outdated else 0)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])